@@ -0,0 +1,353 @@
+"""
+DNS load test for the flancer server half.
+
+Starts a server (in a subprocess) on loopback with N zones of M hosts each,
+optionally churning TXT records, then floods it with UDP and TCP queries for
+existing names, NXDOMAIN names, and names outside every zone. Reports
+throughput and latency percentiles, and appends the results to
+bench/results.jsonl, comparing each scenario with the previous run that used
+the same parameters.
+
+    python bench/dns_bench.py --zones 100 --hosts 50 --churn 20
+
+The server subprocess is 'python bench/dns_bench.py serve ...'.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import select
+import struct
+import random
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, "src"))
+
+def zone_name(z):
+    return "z%d.bench.example" % z
+
+def host_name(z, h):
+    return "h%d.%s" % (h, zone_name(z))
+
+# server side
+
+def serve(args):
+    from twisted.internet import reactor
+    from twisted.internet.task import LoopingCall
+    from twisted.internet.defer import gatherResults, succeed
+    from twisted.names import dns
+    from flancer.server.tap import Server, FlancerDNSServerFactory, log
+    from flancer.eventlog import parse_level
+
+    log.level = parse_level("warn")
+    data = {"zones": {}}
+    for z in range(args.zones):
+        data["zones"][zone_name(z)] = {"server_name": "ns.bench.example",
+                                       "hostname_swissnums": []}
+    factory = FlancerDNSServerFactory(verbose=0)
+    options = {"rate_limit": {"rate": args.rate_limit} if args.rate_limit else None}
+    factory.configure(reactor, **options)
+    s = Server(data, factory)
+    s.update_records()
+    for z in range(args.zones):
+        for h in range(args.hosts):
+            s.add_txt(host_name(z, h), "_acme-challenge", b"x"*43)
+
+    if args.workers:
+        from flancer.server.workers import DNSWorkerPool
+        # the workers run 'python -m flancer.server.workers'
+        os.environ["PYTHONPATH"] = os.pathsep.join(
+            [os.path.join(HERE, os.pardir, "src")]
+            + [p for p in [os.environ.get("PYTHONPATH")] if p])
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        pool = DNSWorkerPool(reactor, s, args.workers, port, "127.0.0.1",
+                             options=options, ready_timeout=60)
+        pool.startService()
+        # ready once every worker has loaded its snapshot and is listening
+        started = gatherResults([pool.served(zone, da.soa[1].serial)
+                                 for (zone, da)
+                                 in s.authorities().items()])
+    else:
+        udp = reactor.listenUDP(0, dns.DNSDatagramProtocol(factory),
+                                interface="127.0.0.1")
+        port = udp.getHost().port
+        reactor.listenTCP(port, factory, interface="127.0.0.1")
+        started = succeed(None)
+
+    if args.churn:
+        # one TXT record is added and another removed, args.churn times/sec
+        def churn():
+            z = random.randrange(args.zones)
+            name = host_name(z, random.randrange(args.hosts))
+            s.add_txt(name, "_churn", b"y"*43)
+            s.delete_txt(name, "_churn")
+        LoopingCall(churn).start(1.0 / args.churn)
+
+    def ready(_):
+        print("READY %d" % port)
+        sys.stdout.flush()
+    started.addCallback(ready)
+    reactor.run()
+
+# client side
+
+def make_query(name, qtype):
+    # header: id=0, RD=0, one question
+    packet = struct.pack("!HHHHHH", 0, 0, 1, 0, 0, 0)
+    for label in name.split("."):
+        packet += struct.pack("!B", len(label)) + label.encode("ascii")
+    return packet + b"\x00" + struct.pack("!HH", qtype, 1)
+
+def with_id(packet, qid):
+    return struct.pack("!H", qid) + packet[2:]
+
+def rcode_of(response):
+    return struct.unpack("!H", response[2:4])[0] & 0xf
+
+def scenario_queries(kind, args):
+    TXT = 16
+    if kind == "hit":
+        return [make_query("_acme-challenge." + host_name(z, h), TXT)
+                for z in range(args.zones) for h in range(args.hosts)]
+    if kind == "nxdomain":
+        return [make_query("_missing%d.%s" % (i, zone_name(i % args.zones)), TXT)
+                for i in range(1000)]
+    if kind == "outzone":
+        return [make_query("www%d.elsewhere.example" % i, TXT)
+                for i in range(1000)]
+    raise ValueError(kind)
+
+def check_answers(port, args):
+    # a flood of errors is fast, so first make sure the server answers
+    # properly, including at the zone apex
+    NS, TXT, ANY = 2, 16, 255
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(args.timeout * 5)
+    s.connect(("127.0.0.1", port))
+    try:
+        for name, qtype in [(zone_name(0), NS), (zone_name(0), ANY),
+                            ("_acme-challenge." + host_name(0, 0), TXT)]:
+            s.send(make_query(name, qtype))
+            response = s.recv(4096)
+            answers = struct.unpack("!H", response[6:8])[0]
+            if rcode_of(response) != 0 or not answers:
+                raise RuntimeError("bad answer to %s type %d: rcode %d,"
+                                   " %d answers" % (name, qtype,
+                                                    rcode_of(response),
+                                                    answers))
+    finally:
+        s.close()
+
+def flood_udp(port, queries, args):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setblocking(False)
+    s.connect(("127.0.0.1", port))
+    outstanding = {} # id -> send time
+    latencies, rcodes, lost = [], {}, 0
+    next_id = 0
+    end = time.time() + args.duration
+    while True:
+        now = time.time()
+        if now >= end and not outstanding:
+            break
+        while now < end and len(outstanding) < args.concurrency:
+            next_id = (next_id + 1) & 0xffff
+            if next_id in outstanding:
+                break
+            s.send(with_id(random.choice(queries), next_id))
+            outstanding[next_id] = now
+        readable, _, _ = select.select([s], [], [], 0.1)
+        if readable:
+            while True:
+                try:
+                    response = s.recv(4096)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                qid = struct.unpack("!H", response[:2])[0]
+                sent = outstanding.pop(qid, None)
+                if sent is not None:
+                    latencies.append(time.time() - sent)
+                    rc = rcode_of(response)
+                    rcodes[rc] = rcodes.get(rc, 0) + 1
+        now = time.time()
+        for qid, sent in list(outstanding.items()):
+            if now - sent > args.timeout:
+                del outstanding[qid]
+                lost += 1
+    s.close()
+    return latencies, rcodes, lost
+
+def _recv_exactly(s, n):
+    data = b""
+    while len(data) < n:
+        chunk = s.recv(n - len(data))
+        if not chunk:
+            raise EOFError("server closed the connection")
+        data += chunk
+    return data
+
+def flood_tcp(port, queries, args):
+    # one query in flight per connection, args.concurrency connections
+    conns = []
+    for i in range(args.concurrency):
+        c = socket.create_connection(("127.0.0.1", port))
+        c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conns.append(c)
+    latencies, rcodes = [], {}
+    sent_at = {}
+    def send(c):
+        q = random.choice(queries)
+        c.sendall(struct.pack("!H", len(q)) + q)
+        sent_at[c] = time.time()
+    end = time.time() + args.duration
+    for c in conns:
+        send(c)
+    while sent_at:
+        readable, _, _ = select.select(list(sent_at), [], [], args.timeout)
+        if not readable:
+            break
+        for c in readable:
+            length = struct.unpack("!H", _recv_exactly(c, 2))[0]
+            response = _recv_exactly(c, length)
+            latencies.append(time.time() - sent_at.pop(c))
+            rc = rcode_of(response)
+            rcodes[rc] = rcodes.get(rc, 0) + 1
+            if time.time() < end:
+                send(c)
+    lost = len(sent_at)
+    for c in conns:
+        c.close()
+    return latencies, rcodes, lost
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+def summarize(latencies, rcodes, lost, duration):
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {"qps": round(len(latencies) / duration, 1),
+            "answered": len(latencies),
+            "lost": lost,
+            "rcodes": dict((str(k), v) for k, v in rcodes.items()),
+            "p50_ms": ms(percentile(latencies, 50)),
+            "p90_ms": ms(percentile(latencies, 90)),
+            "p99_ms": ms(percentile(latencies, 99)),
+            "max_ms": ms(latencies[-1] if latencies else None),
+            }
+
+def git_revision():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                      cwd=HERE, stderr=subprocess.STDOUT)
+        return out.decode("ascii").strip()
+    except Exception:
+        return None
+
+def previous_results(path, params):
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("params") == params:
+                previous = entry
+    return previous
+
+def run(args):
+    cmd = [sys.executable, os.path.abspath(__file__), "serve",
+           "--zones", str(args.zones), "--hosts", str(args.hosts),
+           "--churn", str(args.churn), "--workers", str(args.workers),
+           "--rate-limit", str(args.rate_limit)]
+    server = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        line = server.stdout.readline().decode("ascii").split()
+        if not line or line[0] != "READY":
+            raise RuntimeError("benchmark server failed to start")
+        port = int(line[1])
+        check_answers(port, args)
+        params = {"zones": args.zones, "hosts": args.hosts,
+                  "churn": args.churn, "concurrency": args.concurrency,
+                  "duration": args.duration}
+        # only when set, so earlier results still match
+        for name in ["workers", "rate_limit"]:
+            if getattr(args, name):
+                params[name] = getattr(args, name)
+        results = {}
+        for kind in args.scenarios.split(","):
+            queries = scenario_queries(kind, args)
+            for transport, flood in [("udp", flood_udp), ("tcp", flood_tcp)]:
+                start = time.time()
+                latencies, rcodes, lost = flood(port, queries, args)
+                elapsed = time.time() - start
+                results["%s/%s" % (kind, transport)] = summarize(
+                    latencies, rcodes, lost, elapsed)
+    finally:
+        server.terminate()
+        server.wait()
+
+    previous = previous_results(args.results, params)
+    print("%-16s %10s %9s %9s %9s %6s  %s" % ("scenario", "qps", "p50 ms",
+                                             "p90 ms", "p99 ms", "lost",
+                                             "vs previous"))
+    for name in sorted(results):
+        r = results[name]
+        delta = ""
+        if previous and name in previous["results"] and previous["results"][name]["qps"]:
+            change = r["qps"] / previous["results"][name]["qps"] - 1
+            delta = "%+.1f%% qps (%s)" % (change * 100, previous.get("revision"))
+        print("%-16s %10.1f %9s %9s %9s %6d  %s" % (name, r["qps"], r["p50_ms"],
+                                                  r["p90_ms"], r["p99_ms"],
+                                                  r["lost"], delta))
+    entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+             "revision": git_revision(),
+             "python": sys.version.split()[0],
+             "params": params,
+             "results": results}
+    with open(args.results, "a") as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+def main():
+    p = argparse.ArgumentParser(description="flancer DNS load test")
+    p.add_argument("mode", nargs="?", default="run", choices=["run", "serve"])
+    p.add_argument("--zones", type=int, default=10)
+    p.add_argument("--hosts", type=int, default=100, help="hosts per zone")
+    p.add_argument("--churn", type=float, default=0,
+                   help="TXT add+delete pairs per second during the run")
+    p.add_argument("--workers", type=int, default=0,
+                   help="serve DNS from this many SO_REUSEPORT worker processes")
+    p.add_argument("--rate-limit", type=float, default=0,
+                   help="server --rate-limit (all queries come from one"
+                   " address, so this measures flood shedding)")
+    p.add_argument("--concurrency", type=int, default=32,
+                   help="queries in flight (UDP) or connections (TCP)")
+    p.add_argument("--duration", type=float, default=5.0,
+                   help="seconds per scenario and transport")
+    p.add_argument("--timeout", type=float, default=1.0,
+                   help="seconds before a query counts as lost")
+    p.add_argument("--scenarios", default="hit,nxdomain,outzone")
+    p.add_argument("--results", default=os.path.join(HERE, "results.jsonl"))
+    args = p.parse_args()
+    if args.mode == "serve":
+        serve(args)
+    else:
+        run(args)
+
+if __name__ == "__main__":
+    main()
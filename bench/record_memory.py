@@ -0,0 +1,62 @@
+"""
+Memory used per name by a DynamicAuthority's records, in the plain
+dict-of-lists layout that FileAuthority uses and in CompactRecords, and
+what it costs to read a name back (as a query that misses the answer
+cache does).
+
+    python bench/record_memory.py --hosts 50000
+
+Each host gets a TXT challenge record, and every tenth one a dyndns A and
+AAAA record, which is roughly what a large server holds.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, "src"))
+
+ZONE = "bench.example"
+
+def fill(records, hosts):
+    from twisted.names import dns
+    for h in range(hosts):
+        hostname = "h%d.%s" % (h, ZONE)
+        records["_acme-challenge.%s" % hostname] = [
+            dns.Record_TXT(b"x"*43, ttl=5)]
+        if h % 10 == 0:
+            records["gw%d.%s" % (h, ZONE)] = [
+                dns.Record_A("192.0.2.%d" % (h % 250), ttl=600),
+                dns.Record_AAAA("2001:db8::%x" % h, ttl=600)]
+
+def measure(make, hosts):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = make()
+    fill(records, hosts)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    started = time.time()
+    for name in records:
+        records[name]
+    read_us = (time.time() - started) * 1e6 / len(records)
+    return used, len(records), read_us
+
+def main():
+    from flancer.server.records import CompactRecords
+    p = argparse.ArgumentParser(description="flancer record memory use")
+    p.add_argument("--hosts", type=int, default=50000)
+    args = p.parse_args()
+    print("%-16s %12s %10s %12s" % ("layout", "bytes", "per name",
+                                    "us per read"))
+    for (label, make) in [("dict of lists", dict),
+                          ("CompactRecords", lambda: CompactRecords(ZONE))]:
+        used, names, read_us = measure(make, args.hosts)
+        print("%-16s %12d %10.1f %12.2f" % (label, used, float(used) / names,
+                                            read_us))
+
+if __name__ == "__main__":
+    main()
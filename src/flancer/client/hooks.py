@@ -0,0 +1,99 @@
+import os
+import attr
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.protocol import ProcessProtocol
+from ..eventlog import EventLog
+
+log = EventLog("flancer.client.hooks")
+
+# HOSTNAME.post-update-hook is run after each new certificate is stored, as:
+#   HOSTNAME.post-update-hook HOSTNAME BASEDIR/HOSTNAME.pem
+# A renewal sweep can store hundreds of certificates in a burst, so hooks
+# are debounced per host (several updates in quick succession cause one
+# run), limited to a few at a time, and killed if they take too long.
+
+class _HookProtocol(ProcessProtocol):
+    MAX_OUTPUT = 64*1024
+
+    def __init__(self, done):
+        self._done = done
+        self._output = []
+        self._size = 0
+
+    def outReceived(self, data):
+        if self._size < self.MAX_OUTPUT:
+            data = data[:self.MAX_OUTPUT - self._size]
+            self._output.append(data)
+            self._size += len(data)
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self._done.callback((reason.value.exitCode, reason.value.signal,
+                             b"".join(self._output)))
+
+@attr.s
+class HookRunner(object):
+    _reactor = attr.ib()
+    concurrency = attr.ib(default=4)
+    debounce = attr.ib(default=10.0) # seconds
+    timeout = attr.ib(default=300.0) # seconds
+
+    def __attrs_post_init__(self):
+        self._slots = DeferredSemaphore(self.concurrency)
+        self._scheduled = {} # hostname -> [IDelayedCall, args, waiters]
+
+    def run(self, hostname, hook, pem):
+        """
+        Arrange to run 'hook' for 'hostname' once things have been quiet for
+        self.debounce seconds. Returns a Deferred that fires with (exitCode,
+        signal, output) from the run that covers this request.
+        """
+        d = Deferred()
+        args = [hook.path, hostname, pem.path]
+        entry = self._scheduled.get(hostname)
+        if entry is None:
+            entry = self._scheduled[hostname] = [None, args, []]
+        else:
+            entry[0].cancel()
+            entry[1] = args
+        entry[0] = self._reactor.callLater(self.debounce, self._start, hostname)
+        entry[2].append(d)
+        return d
+
+    def _start(self, hostname):
+        (_, args, waiters) = self._scheduled.pop(hostname)
+        d = self._slots.run(self._spawn, hostname, args)
+        def _done(res):
+            for w in waiters:
+                w.callback(res)
+        def _failed(f):
+            log.error("post-update-hook for {hostname} failed: {failure}",
+                      hostname=hostname, failure=f)
+            for w in waiters:
+                w.errback(f)
+        d.addCallbacks(_done, _failed)
+
+    def _spawn(self, hostname, args):
+        done = Deferred()
+        p = _HookProtocol(done)
+        log.info("running {hook} for {hostname}",
+                 hook=args[0], hostname=hostname)
+        transport = self._reactor.spawnProcess(
+            p, args[0], args, env=os.environ,
+            path=os.path.dirname(args[0]))
+        def _kill():
+            log.warn("post-update-hook for {hostname} timed out, killing it",
+                     hostname=hostname)
+            transport.signalProcess("KILL")
+        killer = self._reactor.callLater(self.timeout, _kill)
+        def _ended(res):
+            if killer.active():
+                killer.cancel()
+            (exitCode, signal, output) = res
+            log.info("post-update-hook for {hostname} exited"
+                     " (code={exitCode}, signal={signal}): {output}",
+                     hostname=hostname, exitCode=exitCode, signal=signal,
+                     output=output)
+            return res
+        done.addCallback(_ended)
+        return done
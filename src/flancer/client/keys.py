@@ -0,0 +1,69 @@
+from collections import deque
+from functools import partial
+import attr
+from twisted.application.service import Service
+from twisted.internet.threads import deferToThreadPool
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.hazmat.backends import default_backend
+from ..eventlog import EventLog
+
+log = EventLog("flancer.client.keys")
+
+# RSA key generation takes long enough to stall the reactor (and with it the
+# dyndns canary and foolscap keepalives), so certificate keys are generated
+# ahead of time in the reactor's thread pool. AcmeIssuingService calls its
+# generate_key synchronously, which is why take() hands out a stocked key and
+# only falls back to generating one inline when the pool has run dry.
+
+KEY_TYPES = {
+    "rsa2048": partial(rsa.generate_private_key, 65537, 2048, default_backend()),
+    "rsa3072": partial(rsa.generate_private_key, 65537, 3072, default_backend()),
+    "rsa4096": partial(rsa.generate_private_key, 65537, 4096, default_backend()),
+    "ecdsa-p256": partial(ec.generate_private_key, ec.SECP256R1(),
+                          default_backend()),
+    }
+
+def key_generator(key_type):
+    if key_type not in KEY_TYPES:
+        raise ValueError("unknown key type '%s', use one of: %s"
+                         % (key_type, ", ".join(sorted(KEY_TYPES))))
+    return KEY_TYPES[key_type]
+
+@attr.s(cmp=False)
+class KeyPool(Service, object):
+    _reactor = attr.ib()
+    _generate = attr.ib()
+    size = attr.ib(default=4)
+
+    def __attrs_post_init__(self):
+        self._keys = deque()
+        self._generating = 0
+
+    def startService(self):
+        Service.startService(self)
+        self._refill()
+
+    def take(self):
+        if self._keys:
+            key = self._keys.popleft()
+        else:
+            log.warn("key pool empty, generating a key on the reactor thread")
+            key = self._generate()
+        if self.running:
+            self._refill()
+        return key
+
+    def _refill(self):
+        while len(self._keys) + self._generating < self.size:
+            self._generating += 1
+            d = deferToThreadPool(self._reactor, self._reactor.getThreadPool(),
+                                  self._generate)
+            d.addCallbacks(self._generated, self._failed)
+
+    def _generated(self, key):
+        self._generating -= 1
+        self._keys.append(key)
+
+    def _failed(self, f):
+        self._generating -= 1
+        log.error("key generation failed: {failure}", failure=f)
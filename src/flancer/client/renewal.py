@@ -0,0 +1,152 @@
+import heapq
+import random
+import calendar
+from datetime import timedelta
+import attr
+from twisted.application.service import Service
+from twisted.internet.defer import DeferredSemaphore
+from txacme.client import Client, ServerError
+from ..eventlog import EventLog
+from ..metrics import metrics
+
+log = EventLog("flancer.client.renewal")
+
+# AcmeIssuingService checks every host at once and renews everything that is
+# due in the same burst, which runs into Let's Encrypt rate limits. Instead
+# we keep a heap of (due time, hostname), where each host is due at a random
+# point in its own renewal window, run a limited number of issuances at a
+# time, and back off (pausing everything if the ACME server says we are
+# rate-limited) when an issuance fails.
+
+def _timestamp(dt):
+    # certificate notAfter dates are naive UTC datetimes
+    return calendar.timegm(dt.utctimetuple())
+
+def _retry_after(failure):
+    """
+    Return the delay the ACME server asked for, or None.
+    """
+    if not failure.check(ServerError):
+        return None
+    typ = getattr(failure.value.message, "typ", None) or ""
+    if typ.split(":")[-1] != "rateLimited":
+        return None
+    return Client.retry_after(failure.value.response, default=3600)
+
+@attr.s(cmp=False)
+class RenewalScheduler(Service, object):
+    _reactor = attr.ib()
+    _data = attr.ib()
+    _store = attr.ib() # FlancerCertificateStore
+    _issue = attr.ib() # server_name -> Deferred, e.g. issuer.issue_cert
+    renew_before = attr.ib(default=timedelta(days=30))
+    window = attr.ib(default=timedelta(days=10))
+    initial_spread = attr.ib(default=timedelta(minutes=5))
+    concurrency = attr.ib(default=2)
+    max_backoff = attr.ib(default=timedelta(days=1))
+
+    def __attrs_post_init__(self):
+        self._heap = [] # (due, server_name), stale entries skipped lazily
+        self._due = {} # server_name -> due
+        self._failures = {} # server_name -> consecutive failures
+        self._issuing = set()
+        self._paused_until = 0
+        self._timer = None
+        self._slots = DeferredSemaphore(self.concurrency)
+
+    def startService(self):
+        # hosts are added by refresh(), which FlancerIssuingService calls
+        # once the ACME account is registered
+        Service.startService(self)
+        self._arm()
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def refresh(self):
+        """
+        Schedule any hosts we have not scheduled yet, e.g. ones added since
+        the last refresh. Hosts that are already scheduled keep their time.
+        """
+        for server_name in self._data["hosts"]:
+            if server_name not in self._due and server_name not in self._issuing:
+                self._schedule_from_expiry(server_name)
+
+    def _schedule_from_expiry(self, server_name):
+        now = self._reactor.seconds()
+        expiry = self._store.expires(server_name)
+        when = now + random.uniform(0, self.initial_spread.total_seconds())
+        if expiry is not None:
+            start = _timestamp(expiry) - self.renew_before.total_seconds()
+            when = max(when, start + random.uniform(0, self.window.total_seconds()))
+        self.schedule(server_name, when)
+
+    def schedule(self, server_name, when):
+        self._due[server_name] = when
+        heapq.heappush(self._heap, (when, server_name))
+        self._arm()
+
+    def _arm(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap or not self.running:
+            return
+        when = self._heap[0][0]
+        if self._timer is not None and self._timer.active():
+            if self._timer.getTime() <= when:
+                return
+            self._timer.cancel()
+        self._timer = self._reactor.callLater(
+            max(0, when - self._reactor.seconds()), self._fire)
+
+    def _fire(self):
+        self._timer = None
+        now = self._reactor.seconds()
+        while self._heap and self._heap[0][0] <= now:
+            (when, server_name) = heapq.heappop(self._heap)
+            if self._due.get(server_name) != when:
+                continue
+            del self._due[server_name]
+            self._start(server_name)
+        self._arm()
+
+    def _start(self, server_name):
+        now = self._reactor.seconds()
+        if self._paused_until > now:
+            spread = random.uniform(0, self.initial_spread.total_seconds())
+            self.schedule(server_name, self._paused_until + spread)
+            return
+        log.info("renewing {server_name}", server_name=server_name)
+        self._issuing.add(server_name)
+        started = metrics.start()
+        d = self._slots.run(self._issue, server_name)
+        d.addCallbacks(self._renewed, self._failed,
+                       callbackArgs=(server_name, started),
+                       errbackArgs=(server_name, started))
+
+    def _renewed(self, _, server_name, started):
+        metrics.inc("flancer_issuances_total", result="ok")
+        metrics.observe_since("flancer_issuance_seconds", started)
+        self._issuing.discard(server_name)
+        self._failures.pop(server_name, None)
+        self._schedule_from_expiry(server_name)
+
+    def _failed(self, f, server_name, started):
+        metrics.inc("flancer_issuances_total", result="error")
+        self._issuing.discard(server_name)
+        failures = self._failures[server_name] = self._failures.get(server_name, 0) + 1
+        now = self._reactor.seconds()
+        delay = _retry_after(f)
+        if delay is not None:
+            # a rate limit applies to the whole account, not just this host
+            self._paused_until = max(self._paused_until, now + delay)
+        else:
+            delay = min(300 * 2 ** (failures - 1),
+                        self.max_backoff.total_seconds())
+        log.error("renewing {server_name} failed, retrying in {delay}s:"
+                  " {failure}", server_name=server_name, delay=delay,
+                  failure=f)
+        self.schedule(server_name, now + delay)
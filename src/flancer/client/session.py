@@ -0,0 +1,121 @@
+import attr
+from twisted.application.service import Service
+from twisted.internet.defer import Deferred, succeed
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool
+from treq.client import HTTPClient
+from josepy.jwa import RS256
+from txacme.client import Client, JWSClient
+from acme.errors import MissingNonce
+from ..eventlog import EventLog
+from ..metrics import metrics
+
+log = EventLog("flancer.client.session")
+
+# AcmeIssuingService calls its client_creator for every issuance, and
+# Client.from_url fetches the ACME directory each time, over a new HTTP
+# connection pool (so a new TLS handshake too), and then fetches a nonce
+# with a HEAD request before its first POST. A renewal sweep of many
+# certificates pays for all that per certificate. An AcmeSession keeps one
+# Client (and one connection pool) for the life of the process, refetches
+# the directory once a day, and keeps a few nonces on hand so concurrent
+# issuances do not each start with a HEAD.
+
+@attr.s(cmp=False)
+class AcmeSession(Service, object):
+    _reactor = attr.ib()
+    url = attr.ib() # the directory, a twisted.python.url.URL
+    _key = attr.ib()
+    _alg = attr.ib(default=RS256)
+    nonces = attr.ib(default=4) # how many to keep on hand
+    connections = attr.ib(default=4) # persistent connections to keep
+
+    DIRECTORY_LIFETIME = 24*60*60
+    # the ACME server forgets nonces after a while: after this long unused,
+    # ours are dropped rather than spent on badNonce retries
+    NONCE_LIFETIME = 5*60
+
+    def __attrs_post_init__(self):
+        self._pool = HTTPConnectionPool(self._reactor)
+        self._pool.maxPersistentPerHost = self.connections
+        agent = Agent(self._reactor, pool=self._pool)
+        self._jws = JWSClient(HTTPClient(agent=agent), self._key, self._alg)
+        self._client = None
+        self._fetched_at = None
+        self._used_at = None
+        self._waiting = None # Deferreds waiting for a directory fetch
+        self._prefetching = 0
+
+    def stopService(self):
+        Service.stopService(self)
+        return self._pool.closeCachedConnections()
+
+    def client(self):
+        """
+        Return a Deferred that fires with the shared Client. This is
+        AcmeIssuingService's client_creator.
+        """
+        now = self._reactor.seconds()
+        if (self._client is not None
+            and now - self._fetched_at < self.DIRECTORY_LIFETIME):
+            metrics.inc("flancer_acme_directory_total", result="cached")
+            self._prefetch_nonces()
+            return succeed(self._client)
+        d = Deferred()
+        if self._waiting is None:
+            # concurrent issuances share one fetch
+            self._waiting = [d]
+            fd = Client.from_url(self._reactor, self.url, self._key,
+                                 self._alg, jws_client=self._jws)
+            fd.addBoth(self._fetched)
+        else:
+            self._waiting.append(d)
+        return d
+
+    def _fetched(self, res):
+        waiting, self._waiting = self._waiting, None
+        if isinstance(res, Failure):
+            metrics.inc("flancer_acme_directory_total", result="error")
+            if self._client is not None:
+                log.warn("unable to refresh the ACME directory, keeping the"
+                         " old one: {failure}", failure=res)
+                res = self._client
+        else:
+            metrics.inc("flancer_acme_directory_total", result="fetched")
+            self._client = res
+            self._fetched_at = self._reactor.seconds()
+            self._prefetch_nonces()
+        for d in waiting:
+            if isinstance(res, Failure):
+                d.errback(res)
+            else:
+                d.callback(res)
+
+    def _prefetch_nonces(self):
+        # JWSClient takes a nonce from its set before each POST, and adds
+        # the one each response carries, so this mostly tops it up for the
+        # first few POSTs of a burst of issuances
+        nonces = self._jws._nonces
+        now = self._reactor.seconds()
+        if (self._used_at is not None
+            and now - self._used_at > self.NONCE_LIFETIME):
+            nonces.clear()
+        self._used_at = now
+        while len(nonces) + self._prefetching < self.nonces:
+            self._prefetching += 1
+            d = self._jws.head(self.url.asText())
+            d.addCallback(self._jws._add_nonce)
+            d.addErrback(self._prefetch_failed)
+            d.addBoth(self._prefetched)
+
+    def _prefetched(self, _):
+        self._prefetching -= 1
+
+    def _prefetch_failed(self, f):
+        if f.check(MissingNonce):
+            # the server only hands them out elsewhere: JWSClient will fetch
+            # its own
+            log.info("ACME directory gives no nonces, not prefetching")
+            self.nonces = 0
+        else:
+            log.warn("unable to prefetch an ACME nonce: {failure}", failure=f)
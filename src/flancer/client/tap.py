@@ -1,23 +1,26 @@
 from __future__ import print_function
 import os
-import json
 import hashlib
 import attr
-from pem import parse
+from pem import parse, Certificate, Key
 from zope.interface import implementer
 from operator import methodcaller
 from twisted.internet import reactor
 from twisted.python import usage
 from twisted.application.service import MultiService
 #from twisted.application.internet import TimerService
-from foolscap.api import Tub, Referenceable
+from foolscap.api import Tub, Referenceable, DeadReferenceError
 
 from functools import partial
 
-from twisted.internet.defer import inlineCallbacks, returnValue, succeed, maybeDeferred
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed, maybeDeferred, Deferred
+from twisted.internet.defer import gatherResults, FirstError
 from twisted.python.filepath import FilePath
+from twisted.python.failure import Failure
+from twisted.internet.task import deferLater
 #from twisted.logger import globalLogBeginner, textFileLogObserver
 
+from cryptography import x509
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 
@@ -26,12 +29,20 @@ from josepy.jwa import RS256
 from josepy.b64 import b64encode
 
 from txacme.service import AcmeIssuingService
-from txacme.client import Client
+from txacme.client import answer_challenge, fqdn_identifier, poll_until_valid
+from txacme.messages import CertificateRequest
 from txacme.urls import LETSENCRYPT_DIRECTORY, LETSENCRYPT_STAGING_DIRECTORY
-from txacme.util import generate_private_key
+from txacme.util import generate_private_key, csr_for_names, tap
 from txacme.errors import NotInZone
 from txacme.interfaces import ICertificateStore
 
+from ..journal import JournaledDict
+from .hooks import HookRunner
+from .keys import KeyPool, key_generator
+from .renewal import RenewalScheduler
+from .session import AcmeSession
+from ..metrics import metrics, makeMetricsService
+
 
 LONGDESC = """\
 Flancer client-side daemon.
@@ -65,6 +76,13 @@ def _validation(response):
     h = hashlib.sha256(response.key_authorization.encode("utf-8"))
     return b64encode(h.digest()).decode()
 
+def _fsync_dir(fp):
+    fd = os.open(fp.path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 @attr.s
 @implementer(ICertificateStore)
 class FlancerCertificateStore(object):
@@ -74,43 +92,262 @@ class FlancerCertificateStore(object):
 
     _data = attr.ib()
     _path = attr.ib(converter=methodcaller('asTextMode')) # .../certs/
+    _hooks = attr.ib(default=None) # HookRunner
 
-    def _get(self, server_name):
+    def __attrs_post_init__(self):
+        # as_dict() is polled for every host on each issuer check, so parsed
+        # PEM objects are kept until store() or a change to the file's
+        # mtime/size tells us they are stale
+        self._cache = {} # server_name -> [(mtime, size), pem_objects, expiry]
+
+    def _entry(self, server_name):
         if server_name not in self._data["hosts"]:
             raise KeyError(server_name)
         pem = self._path.child(server_name+".pem")
+        pem.restat(False)
         if pem.isfile():
-            return parse(pem.getContent())
-        return parse(b"")
+            stamp = (pem.getModificationTime(), pem.getsize())
+        else:
+            stamp = None
+        entry = self._cache.get(server_name)
+        if entry is None or entry[0] != stamp:
+            pem_objects = parse(pem.getContent()) if stamp else parse(b"")
+            entry = self._cache[server_name] = [stamp, pem_objects, None]
+        return entry
+
+    def _get(self, server_name):
+        return list(self._entry(server_name)[1])
+
+    def names(self, server_name):
+        """
+        Return every name to put on the host's certificate: the server may
+        have granted us more than one (or a *.ZONE wildcard) under it.
+        """
+        return self._data.get("names", {}).get(server_name, [server_name])
+
+    def expires(self, server_name):
+        """
+        Return the notAfter datetime of the host's certificate, or None if
+        it does not have one yet.
+        """
+        entry = self._entry(server_name)
+        if entry[2] is None:
+            for o in entry[1]:
+                if isinstance(o, Certificate):
+                    cert = x509.load_pem_x509_certificate(o.as_bytes(),
+                                                          default_backend())
+                    entry[2] = cert.not_valid_after
+                    break
+        return entry[2]
 
     def get(self, server_name):
         return maybeDeferred(self._get, server_name)
 
-    @inlineCallbacks
-    def store(self, server_name, pem_objects):
-        self._path.child(server_name+".privkey.pem").setContent(pem_objects[0].as_bytes())
-        self._path.child(server_name+".cert.pem").setContent(pem_objects[1].as_bytes())
+    # Each issuance is written into a fresh directory,
+    # HOSTNAME.versions/N/, and published by atomically repointing the
+    # HOSTNAME.versions/current symlink at it. The HOSTNAME.pem (etc) files
+    # are stable symlinks through 'current', so readers never see a new
+    # certificate next to an old key.
+    KEEP_VERSIONS = 2
+    ARTIFACTS = [".privkey.pem", ".cert.pem", ".chain.pem", ".fullchain.pem",
+                 ".pem"]
+
+    def _version_filename(self, suffix):
+        # HOSTNAME.pem is HOSTNAME.versions/current/everything.pem
+        return suffix[1:] if suffix != ".pem" else "everything.pem"
+
+    def _write_version(self, versions, pem_objects):
+        numbers = [int(c.basename()) for c in versions.children()
+                   if c.basename().isdigit()]
+        version = versions.child(str(max(numbers + [0]) + 1))
+        version.makedirs()
+        contents = {
+            ".privkey.pem": pem_objects[0].as_bytes(),
+            ".cert.pem": pem_objects[1].as_bytes(),
+            ".fullchain.pem": b''.join(o.as_bytes() for o in pem_objects[1:]),
+            ".pem": b''.join(o.as_bytes() for o in pem_objects),
+            }
         chain_certs = pem_objects[2:]
         if chain_certs:
-            self._path.child(server_name+".chain.pem").setContent(b''.join(o.as_bytes() for o in chain_certs))
-        fullchain = b''.join(o.as_bytes() for o in pem_objects[1:])
-        self._path.child(server_name+".fullchain.pem").setContent(fullchain)
+            contents[".chain.pem"] = b''.join(o.as_bytes() for o in chain_certs)
+        for suffix, content in contents.items():
+            with open(version.child(self._version_filename(suffix)).path,
+                      "wb") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+        _fsync_dir(version)
+        return version
+
+    def _publish(self, server_name, versions, version):
+        current = versions.child("current")
+        tmp = versions.child("current.tmp")
+        if tmp.islink():
+            tmp.remove()
+        os.symlink(version.basename(), tmp.path)
+        os.rename(tmp.path, current.path)
+        for suffix in self.ARTIFACTS:
+            filename = self._version_filename(suffix)
+            if not version.child(filename).exists():
+                continue
+            link = self._path.child(server_name+suffix)
+            target = os.path.join(versions.basename(), "current", filename)
+            if link.islink() and os.readlink(link.path) == target:
+                continue
+            # replaces an old-style regular file, or a stale link, atomically
+            tmp = self._path.child(server_name+suffix+".tmp")
+            if tmp.islink():
+                tmp.remove()
+            os.symlink(target, tmp.path)
+            os.rename(tmp.path, link.path)
+        _fsync_dir(versions)
+        _fsync_dir(self._path)
+
+    def _prune(self, versions):
+        numbers = sorted(int(c.basename()) for c in versions.children()
+                         if c.basename().isdigit())
+        for n in numbers[:-self.KEEP_VERSIONS]:
+            versions.child(str(n)).remove()
 
-        everything = b''.join(o.as_bytes() for o in pem_objects)
-        self._path.child(server_name+".pem").setContent(everything)
+    def store(self, server_name, pem_objects):
+        self._cache.pop(server_name, None)
+        versions = self._path.child(server_name+".versions")
+        versions.makedirs(ignoreExistingDirectory=True)
+        version = self._write_version(versions, pem_objects)
+        self._publish(server_name, versions, version)
+        self._prune(versions)
 
         h = self._path.child(server_name+".post-update-hook")
         if h.isfile() and h.getPermissions().user.execute:
-            yield self._run_hook(h)
-        returnValue(None)
-
-    def _run_hook(self, h):
-        print("pretending to run post-update-hook")
+            self._run_hook(server_name, h)
+        return succeed(None)
+
+    def _run_hook(self, server_name, h):
+        # issuance does not wait for the hook; HookRunner logs failures
+        if self._hooks is None:
+            print("no hook runner, not running %s" % h.path)
+            return
+        d = self._hooks.run(server_name, h,
+                            self._path.child(server_name+".pem"))
+        d.addErrback(lambda f: None)
 
     def as_dict(self):
         return succeed( { h: self._get(h)
                           for h in self._data["hosts"].keys() } )
 
+@attr.s(cmp=False)
+class PollClock(object):
+    """
+    The issuer's clock. txacme's poll_until_valid sleeps for the ACME
+    server's Retry-After between polls of an authorization: wake() cuts
+    those sleeps short once the server tells us the validation queries have
+    arrived. Longer delays (the poll timeout, the periodic check) are left
+    alone.
+    """
+    _reactor = attr.ib()
+
+    MAX_POLL_DELAY = 60
+
+    def __attrs_post_init__(self):
+        self._polls = set()
+
+    def seconds(self):
+        return self._reactor.seconds()
+
+    def getDelayedCalls(self):
+        return self._reactor.getDelayedCalls()
+
+    def callLater(self, delay, f, *args, **kwargs):
+        if delay > self.MAX_POLL_DELAY:
+            return self._reactor.callLater(delay, f, *args, **kwargs)
+        def fire():
+            self._polls.discard(call)
+            f(*args, **kwargs)
+        call = self._reactor.callLater(delay, fire)
+        self._polls.add(call)
+        return call
+
+    def wake(self, delay):
+        for call in list(self._polls):
+            if not call.active():
+                self._polls.discard(call)
+            elif call.getTime() > self.seconds() + delay:
+                call.reset(delay)
+
+class FlancerIssuingService(AcmeIssuingService):
+    # Renewals are left to a RenewalScheduler. The periodic check only makes
+    # sure we are registered, then tells the scheduler about any new hosts.
+    scheduler = None
+
+    def _check_certs(self):
+        def done(_):
+            if self.scheduler is not None:
+                self.scheduler.refresh()
+            self.ready = True
+            for d in list(self._waiting):
+                d.callback(None)
+            self._waiting = []
+        d = self._ensure_registered()
+        d.addCallback(done)
+        d.addErrback(lambda f: print("error in scheduled check: %s" % (f,)))
+        return d
+
+    def _issue_cert(self, client, server_name):
+        # Like txacme's, but the certificate gets every name in
+        # cert_store.names(), for one issuance. Every name's challenge is
+        # fetched before any is answered, so all their start_responding
+        # calls happen together and the TXT records go to the server in one
+        # update_txts batch.
+        names = self.cert_store.names(server_name)
+        print("requesting a certificate for %s" % ", ".join(names))
+        key = self._generate_key()
+        objects = [
+            Key(key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.TraditionalOpenSSL,
+                encryption_algorithm=serialization.NoEncryption()))]
+
+        def answer_and_poll(authzr):
+            def got_challenge(stop_responding):
+                d = poll_until_valid(authzr, self._clock, client)
+                d.addBoth(tap(lambda _: stop_responding()))
+                return d
+            d = answer_challenge(authzr, client, self._responders)
+            d.addCallback(got_challenge)
+            return d
+
+        def gather(ds):
+            d = gatherResults(ds, consumeErrors=True)
+            d.addErrback(lambda f: f.value.subFailure if f.check(FirstError)
+                         else f)
+            return d
+
+        def got_cert(certr):
+            objects.append(
+                Certificate(
+                    x509.load_der_x509_certificate(certr.body,
+                                                   default_backend())
+                    .public_bytes(serialization.Encoding.PEM)))
+            return certr
+
+        def got_chain(chain):
+            for certr in chain:
+                got_cert(certr)
+            print("received certificate for %s" % ", ".join(names))
+            return objects
+
+        d = gather([client.request_challenges(fqdn_identifier(name))
+                    for name in names])
+        d.addCallback(lambda authzrs: gather([answer_and_poll(authzr)
+                                              for authzr in authzrs]))
+        d.addCallback(lambda _: client.request_issuance(
+            CertificateRequest(csr=csr_for_names(names, key))))
+        d.addCallback(got_cert)
+        d.addCallback(client.fetch_chain)
+        d.addCallback(got_chain)
+        d.addCallback(partial(self.cert_store.store, server_name))
+        return d
+
 class Options(usage.Options):
     synopsis = "[options..]"
     longdesc = LONGDESC
@@ -120,8 +357,22 @@ class Options(usage.Options):
         ]
     optParameters = [
         ("basedir", None, "~/.flancer-client", "directory to hold config.json"),
+        ("hook-concurrency", None, "4", "maximum number of post-update hooks to run at once"),
+        ("hook-debounce", None, "10", "seconds to wait for further updates to a host before running its hook"),
+        ("hook-timeout", None, "300", "seconds after which a post-update hook is killed"),
+        ("key-type", None, "rsa2048", "type of certificate key: rsa2048, rsa3072, rsa4096, or ecdsa-p256"),
+        ("key-pool-size", None, "4", "number of certificate keys to generate ahead of time"),
+        ("renewal-concurrency", None, "2", "maximum number of certificates to renew at once"),
+        ("metrics-port", None, None, "endpoint (e.g. tcp:9101:interface=127.0.0.1) on which to serve Prometheus metrics"),
+        ("metrics-log-interval", None, "0", "seconds between metrics summaries in the log, 0 to disable"),
         ]
 
+    def postOptions(self):
+        try:
+            key_generator(self["key-type"])
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+
 
 def maybe_key(pem_path):
     acme_key_file = pem_path.child(u'client.key')
@@ -147,18 +398,11 @@ def maybe_key(pem_path):
 #globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stdout)])
 
 @attr.s
-class Data(dict):
-    _fn = attr.ib(converter=methodcaller('asTextMode')) # BASEDIR/config.json
-
-    def __attrs_post_init__(self):
-        if not self._fn.isfile():
-            self["hosts"] = {}
-            self._fn.setContent(json.dumps(self).encode("utf-8")+"\n")
-        for k,v in json.loads(self._fn.getContent().decode("utf-8")).items():
-            self[k] = v
+class Data(JournaledDict):
+    # BASEDIR/config.json, plus BASEDIR/config.json.journal
 
-    def save(self):
-        self._fn.setContent(json.dumps(self).encode("utf-8")+"\n")
+    def initial(self):
+        return {"hosts": {}}
 
 @attr.s
 class FlancerResponder(object):
@@ -166,29 +410,209 @@ class FlancerResponder(object):
 
     _tub = attr.ib()
     _data = attr.ib()
+    _reactor = attr.ib(default=reactor)
+    _poll_clock = attr.ib(default=None) # PollClock, woken by query events
+
+    CONNECT_ATTEMPTS = 5
+    MAX_BACKOFF = 60.0
+    # validation is usually done this long after the first query arrives
+    POLL_AFTER_QUERY = 1.0
+    # how long a change waits for others to share its update_txts message
+    BATCH_WINDOW = 0.1
+
+    def __attrs_post_init__(self):
+        # challenges started (or stopped) within BATCH_WINDOW of each other,
+        # e.g. by a renewal sweep whose ACME responses arrive one by one, go
+        # to the server in one update_txts message
+        self._batches = {} # furl -> list of (change, Deferred)
+        # live RemoteReferences are reused until they disconnect
+        self._refs = {} # furl -> RemoteReference
+        self._connecting = {} # furl -> list of Deferreds waiting for it
+        self._observer = _ChallengeObserver(self)
+
+    def _get_reference(self, furl):
+        if furl in self._refs:
+            return succeed(self._refs[furl])
+        d = Deferred()
+        if furl in self._connecting:
+            self._connecting[furl].append(d)
+        else:
+            self._connecting[furl] = [d]
+            self._connect(furl).addBoth(self._connected, furl)
+        return d
+
+    @inlineCallbacks
+    def _connect(self, furl):
+        delay = 1.0
+        for attempt in range(self.CONNECT_ATTEMPTS):
+            try:
+                rref = yield self._tub.getReference(furl)
+                break
+            except Exception:
+                if attempt == self.CONNECT_ATTEMPTS - 1:
+                    raise
+            yield deferLater(self._reactor, delay, lambda: None)
+            delay = min(delay * 2, self.MAX_BACKOFF)
+        self._refs[furl] = rref
+        rref.notifyOnDisconnect(self._lost, furl, rref)
+        # ask to hear when resolvers look up our challenges (servers from
+        # before remote_subscribe just don't tell us)
+        d = rref.callRemote("subscribe", self._observer)
+        d.addErrback(lambda f: print("unable to subscribe to challenge"
+                                     " queries: %s" % (f.value,)))
+        returnValue(rref)
+
+    def _connected(self, res, furl):
+        for d in self._connecting.pop(furl):
+            if isinstance(res, Failure):
+                d.errback(res)
+            else:
+                d.callback(res)
+
+    def _lost(self, furl, rref):
+        if self._refs.get(furl) is rref:
+            del self._refs[furl]
+
+    def _update_txt(self, furl, change):
+        d = Deferred()
+        if furl not in self._batches:
+            self._batches[furl] = []
+            self._reactor.callLater(self.BATCH_WINDOW, self._flush, furl)
+        self._batches[furl].append((change, d))
+        return d
+
+    @inlineCallbacks
+    def _flush(self, furl):
+        batch = self._batches.pop(furl)
+        changes = [change for (change, d) in batch]
+        started = metrics.start()
+        try:
+            rr = yield self._get_reference(furl)
+            try:
+                results = yield self._update_txts(rr, changes)
+            except DeadReferenceError:
+                # the connection went away before we noticed: reconnect once
+                self._lost(furl, rr)
+                rr = yield self._get_reference(furl)
+                results = yield self._update_txts(rr, changes)
+        except Exception:
+            f = Failure()
+            for (change, d) in batch:
+                metrics.inc("flancer_challenges_total",
+                            op="stop" if change[2] is None else "start",
+                            result="error")
+                d.errback(f)
+            return
+        metrics.observe_since("flancer_update_txts_seconds", started)
+        added = [change for ((change, d), (ok, error)) in zip(batch, results)
+                 if ok and change[2] is not None]
+        not_served = yield self._confirm(rr, added)
+        for (change, d), (ok, error) in zip(batch, results):
+            if change in not_served:
+                (ok, error) = (False, not_served[change])
+            metrics.inc("flancer_challenges_total",
+                        op="stop" if change[2] is None else "start",
+                        result="ok" if ok else "error")
+            if ok:
+                d.callback(None)
+            else:
+                d.errback(ValueError(error))
+
+    @inlineCallbacks
+    def _update_txts(self, rr, changes):
+        try:
+            results = yield rr.callRemote("update_txts", changes)
+        except DeadReferenceError:
+            raise
+        except Exception as e:
+            # e.g. a server from before update_txts: one call per change.
+            # Those only granted the furl's own hostname, so set_txt and
+            # delete_txt need no hostname.
+            print("unable to update_txts (%s), setting records one at a time"
+                  % (e,))
+            results = []
+            for (hostname, txtname, data) in changes:
+                try:
+                    if data is None:
+                        yield rr.callRemote("delete_txt", txtname)
+                    else:
+                        yield rr.callRemote("set_txt", txtname, data)
+                except DeadReferenceError:
+                    raise
+                except Exception as e:
+                    results.append((False, str(e)))
+                else:
+                    results.append((True, None))
+        returnValue(results)
+
+    def challenge_queried(self, name, resolver, age):
+        print("%s queried by %s, %.1fs after it was set" % (name, resolver,
+                                                            age))
+        metrics.inc("flancer_challenge_queries_seen_total")
+        if self._poll_clock is not None:
+            self._poll_clock.wake(self.POLL_AFTER_QUERY)
+
+    @inlineCallbacks
+    def _confirm(self, rr, changes):
+        # Wait until the server says the new records are actually being
+        # served, so the ACME server is asked to validate as soon as that
+        # will work, and no sooner. Returns {change: error} for records that
+        # are not.
+        if not changes:
+            returnValue({})
+        try:
+            results = yield rr.callRemote("confirm_txts", changes)
+        except Exception as e:
+            # e.g. a server from before confirm_txts: carry on unconfirmed
+            print("unable to confirm challenge records: %s" % (e,))
+            returnValue({})
+        returnValue(dict((change, error)
+                         for (change, (ok, error)) in zip(changes, results)
+                         if not ok))
+
+    def _furl_for(self, domain):
+        # 'domain' is one of our hosts, another name on its certificate, or
+        # the zone of a *.ZONE one
+        hosts = self._data["hosts"]
+        for name in (domain, "*." + domain):
+            if name in hosts:
+                return hosts[name].encode("ascii")
+        for host, names in self._data.get("names", {}).items():
+            if domain in names or "*." + domain in names:
+                return hosts[host].encode("ascii")
+        raise KeyError(domain)
 
     @inlineCallbacks
     def start_responding(self, server_name, challenge, response):
-        # This 'server_name' is like test1.sf.example.com
+        # This 'server_name' is like test1.sf.example.com, or for a
+        # wildcard certificate *.sf.example.com, which is validated at
+        # sf.example.com
         print("start_responding", server_name)
         validation = _validation(response)
-        full_name = challenge.validation_domain_name(server_name)
-        # full_name is _acme-challenge.$SERVERNAME
-        subdomain = _split_zone(full_name, server_name)
+        domain = server_name[2:] if server_name.startswith("*.") else server_name
+        full_name = challenge.validation_domain_name(domain)
+        # full_name is _acme-challenge.$DOMAIN
+        subdomain = _split_zone(full_name, domain)
         # subdomain should always just be _acme-challenge
         #print("full_name", full_name)
-        furl = self._data["hosts"][server_name].encode("ascii")
-        rr = yield self._tub.getReference(furl)
-        yield rr.callRemote("set_txt", subdomain, validation.encode("ascii"))
+        furl = self._furl_for(domain)
+        yield self._update_txt(furl, (domain, subdomain,
+                                      validation.encode("ascii")))
 
     @inlineCallbacks
     def stop_responding(self, server_name, challenge, response):
         print("stop_responding", server_name)
-        full_name = challenge.validation_domain_name(server_name)
-        subdomain = _split_zone(full_name, server_name)
-        furl = self._data["hosts"][server_name].encode("ascii")
-        rr = yield self._tub.getReference(furl)
-        yield rr.callRemote("delete_txt", subdomain)
+        domain = server_name[2:] if server_name.startswith("*.") else server_name
+        full_name = challenge.validation_domain_name(domain)
+        subdomain = _split_zone(full_name, domain)
+        furl = self._furl_for(domain)
+        yield self._update_txt(furl, (domain, subdomain, None))
+
+class _ChallengeObserver(Referenceable):
+    def __init__(self, responder):
+        self._responder = responder
+    def remote_challenge_queried(self, name, resolver, age):
+        self._responder.challenge_queried(name, resolver, age)
 
 def start_dyndns_canary(tub, furl):
     class Canary(Referenceable):
@@ -207,11 +631,17 @@ class Controller(Referenceable, object):
     def remote_accept_add_host(self, furl):
         rr = yield self._tub.getReference(furl)
         hostname = yield rr.callRemote("get_hostname")
+        try:
+            names = yield rr.callRemote("get_names")
+        except Exception:
+            names = [hostname] # a server from before get_names
         print("adding hostname '%s'" % hostname)
         # add furl and hostname to config, to remember that we want a cert
-        self._data["hosts"][hostname] = furl
+        # (for all of 'names', if the server granted us more than one)
         try:
-            self._data.save()
+            if names != [hostname]:
+                self._data.set(["names", hostname], names, create=True)
+            self._data.set(["hosts", hostname], furl)
         except:
             from twisted.python.failure import Failure
             print(Failure())
@@ -222,9 +652,8 @@ class Controller(Referenceable, object):
 
     @inlineCallbacks
     def remote_accept_add_dyndns(self, furl):
-        self._data["dyndns_furl"] = furl
         try:
-            self._data.save()
+            self._data.set(["dyndns_furl"], furl)
         except:
             from twisted.python.failure import Failure
             print(Failure())
@@ -251,7 +680,11 @@ def makeService(config, reactor=reactor):
 
     acme_path = basedir.asTextMode()
     acme_key = maybe_key(acme_path)
-    cert_store = FlancerCertificateStore(data, basedir)
+    hooks = HookRunner(reactor,
+                       concurrency=int(config["hook-concurrency"]),
+                       debounce=float(config["hook-debounce"]),
+                       timeout=float(config["hook-timeout"]))
+    cert_store = FlancerCertificateStore(data, basedir, hooks)
     staging = not config["really"]
     if staging:
         print("STAGING mode")
@@ -259,12 +692,26 @@ def makeService(config, reactor=reactor):
     else:
         print("REAL CERTIFICATE mode")
         le_url = LETSENCRYPT_DIRECTORY
-    client_creator = partial(Client.from_url, reactor=reactor,
-                             url=le_url,
-                             key=acme_key, alg=RS256)
-    r = FlancerResponder(tub, data)
-    issuer = AcmeIssuingService(cert_store, client_creator, reactor, [r])
+    # one ACME client (directory, connections, nonces) for every issuance
+    session = AcmeSession(reactor, le_url, acme_key, RS256)
+    session.setServiceParent(parent)
+    keys = KeyPool(reactor, key_generator(config["key-type"]),
+                   int(config["key-pool-size"]))
+    keys.setServiceParent(parent)
+    poll_clock = PollClock(reactor)
+    r = FlancerResponder(tub, data, reactor, poll_clock)
+    issuer = FlancerIssuingService(cert_store, session.client, poll_clock, [r],
+                                   generate_key=keys.take)
     issuer.setServiceParent(parent)
+    renewals = RenewalScheduler(reactor, data, cert_store, issuer.issue_cert,
+                                concurrency=int(config["renewal-concurrency"]))
+    issuer.scheduler = renewals
+    renewals.setServiceParent(parent)
+
+    if config["metrics-port"] or float(config["metrics-log-interval"]):
+        ms = makeMetricsService(config["metrics-port"],
+                                float(config["metrics-log-interval"]))
+        ms.setServiceParent(parent)
 
     if "dyndns_furl" in data:
         start_dyndns_canary(tub, data["dyndns_furl"].encode("ascii"))
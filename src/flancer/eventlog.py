@@ -0,0 +1,69 @@
+import time
+import attr
+from twisted.logger import Logger, LogLevel, InvalidLogLevelError
+
+# twisted.logger formats events lazily, but every emitted event still walks
+# the observer chain. For the per-query and per-mutation paths we want two
+# more things: a level check that costs one comparison when the event is not
+# wanted, and a cap on how many copies of the same event a flood can produce.
+
+def parse_level(name):
+    """
+    Turn 'debug'/'info'/'warn'/'error'/'critical' into a LogLevel, raising
+    ValueError for anything else.
+    """
+    try:
+        return LogLevel.levelWithName(name)
+    except InvalidLogLevelError:
+        raise ValueError("unknown log level '%s'" % (name,))
+
+@attr.s(cmp=False)
+class EventLog(object):
+    """
+    A Logger with a minimum level and per-format rate limiting: each format
+    string is emitted at most `burst` times per `interval` seconds, and the
+    number of suppressed copies is reported when the window rolls over.
+    """
+    namespace = attr.ib()
+    level = attr.ib(default=LogLevel.info)
+    burst = attr.ib(default=20)
+    interval = attr.ib(default=1.0)
+    _clock = attr.ib(default=time.time)
+
+    def __attrs_post_init__(self):
+        self._log = Logger(namespace=self.namespace)
+        self._windows = {} # format -> [window_start, emitted, suppressed]
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def emit(self, level, format, **kwargs):
+        if level < self.level:
+            return
+        now = self._clock()
+        w = self._windows.get(format)
+        if w is None:
+            w = self._windows[format] = [now, 0, 0]
+        elif now - w[0] >= self.interval:
+            if w[2]:
+                self._log.emit(LogLevel.warn,
+                               "suppressed {suppressed} events like: {like}",
+                               suppressed=w[2], like=format)
+            w[0], w[1], w[2] = now, 0, 0
+        if w[1] < self.burst:
+            w[1] += 1
+            self._log.emit(level, format, **kwargs)
+        else:
+            w[2] += 1
+
+    def debug(self, format, **kwargs):
+        self.emit(LogLevel.debug, format, **kwargs)
+
+    def info(self, format, **kwargs):
+        self.emit(LogLevel.info, format, **kwargs)
+
+    def warn(self, format, **kwargs):
+        self.emit(LogLevel.warn, format, **kwargs)
+
+    def error(self, format, **kwargs):
+        self.emit(LogLevel.error, format, **kwargs)
@@ -0,0 +1,142 @@
+import os
+import json
+import attr
+from operator import methodcaller
+
+# Both halves keep their state in a dict that is persisted as BASEDIR/config.json.
+# Rewriting the whole file for every new host makes bulk enrollment
+# quadratic, and a crash in the middle of a rewrite can lose the config. So
+# each change is appended to config.json.journal as one JSON line, and the
+# journal is folded into a new snapshot (written to a temporary file and
+# renamed into place) at startup, on save(), and every COMPACT_EVERY changes.
+#
+# The snapshot records the sequence number of the last change it contains,
+# so replaying a journal that was not truncated before a crash is harmless.
+
+SEQ_KEY = "journal_seq"
+
+def _resolve(d, path, create=False):
+    for key in path:
+        if create and key not in d:
+            d[key] = {}
+        d = d[key]
+    return d
+
+def _apply(d, op, path, value=None, create=False):
+    parent = _resolve(d, path[:-1], create)
+    if op == "set":
+        parent[path[-1]] = value
+    elif op == "append":
+        parent.setdefault(path[-1], []).append(value)
+    elif op == "delete":
+        del parent[path[-1]]
+    else:
+        raise ValueError("unknown journal op '%s'" % (op,))
+
+def write_atomically(fn, content):
+    tmp = fn.temporarySibling(".tmp")
+    with open(tmp.path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    tmp.moveTo(fn)
+
+@attr.s
+class JournaledDict(dict):
+    _fn = attr.ib(converter=methodcaller('asTextMode')) # BASEDIR/config.json
+
+    COMPACT_EVERY = 1000
+
+    def initial(self):
+        """
+        Return the contents for a brand new config file.
+        """
+        return {}
+
+    def __attrs_post_init__(self):
+        self._journal_fn = self._fn.siblingExtension(".journal")
+        self._journal = None
+        self._pending = 0 # changes in the journal since the last snapshot
+        if self._fn.isfile():
+            snapshot = json.loads(self._fn.getContent().decode("utf-8"))
+        else:
+            snapshot = self.initial()
+        self._seq = snapshot.pop(SEQ_KEY, 0)
+        self.update(snapshot)
+        self._replay()
+        # a leftover journal is always folded in and removed, even if it
+        # held nothing new: new entries must not be appended after a torn line
+        if self._journal_fn.exists() or not self._fn.isfile():
+            self.save()
+
+    def _replay(self):
+        if not self._journal_fn.isfile():
+            return 0
+        replayed = 0
+        for line in self._journal_fn.getContent().decode("utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break # torn final write: everything after it is lost too
+            if entry["seq"] <= self._seq:
+                continue
+            # entries from before "create" was recorded always created
+            _apply(self, entry["op"], entry["path"], entry.get("value"),
+                   entry.get("create", entry["op"] != "delete"))
+            self._seq = entry["seq"]
+            replayed += 1
+        return replayed
+
+    def _record(self, op, path, value=None, create=False):
+        # raises KeyError, before anything is written, if the path is missing
+        _apply(self, op, path, value, create)
+        self._seq += 1
+        entry = {"seq": self._seq, "op": op, "path": path}
+        if op != "delete":
+            entry["value"] = value
+        if create:
+            entry["create"] = True
+        if self._journal is None:
+            self._journal = open(self._journal_fn.path, "ab")
+        self._journal.write((json.dumps(entry) + "\n").encode("utf-8"))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._pending += 1
+        if self._pending >= self.COMPACT_EVERY:
+            self.save()
+
+    def set(self, path, value, create=False):
+        """
+        Set self[path[0]][path[1]].. = value, and record the change durably.
+        Missing intermediate dicts are a KeyError, unless 'create'.
+        """
+        self._record("set", list(path), value, create)
+
+    def append(self, path, value, create=False):
+        """
+        Append value to the list at self[path[0]][path[1]].., and record the
+        change durably. Missing intermediate dicts are a KeyError, unless
+        'create'.
+        """
+        self._record("append", list(path), value, create)
+
+    def delete(self, path):
+        """
+        Remove self[path[0]][path[1]].., and record the change durably.
+        """
+        self._record("delete", list(path))
+
+    def save(self):
+        """
+        Write a complete snapshot and empty the journal.
+        """
+        snapshot = dict(self)
+        snapshot[SEQ_KEY] = self._seq
+        write_atomically(self._fn,
+                          (json.dumps(snapshot) + "\n").encode("utf-8"))
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self._journal_fn.exists():
+            self._journal_fn.remove()
+        self._pending = 0
@@ -0,0 +1,160 @@
+import time
+import attr
+from twisted.application.service import MultiService
+from twisted.application.internet import TimerService
+from twisted.application import strports
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from .eventlog import EventLog
+
+log = EventLog("flancer.metrics")
+
+# Counters, gauges and latency histograms for both halves. Everything is
+# recorded into the module-level 'metrics' object, which does nothing until
+# makeMetricsService() enables it, so the disabled cost of a call site is one
+# attribute check. When enabled, the values can be scraped in Prometheus text
+# format over HTTP and/or summarized in the log periodically.
+
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30,
+           60, float("inf")) # seconds
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for (k, v) in pairs)
+
+def _format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+@attr.s(cmp=False)
+class Metrics(object):
+    enabled = attr.ib(default=False)
+
+    def __attrs_post_init__(self):
+        self._counters = {} # name -> {label key: value}
+        self._histograms = {} # name -> {label key: [bucket counts.., sum]}
+        self._gauges = {} # name -> callable, see gauge()
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        values = self._counters.setdefault(name, {})
+        key = _key(labels)
+        values[key] = values.get(key, 0) + amount
+
+    def start(self):
+        """
+        Return a start time for observe_since(), or None when disabled.
+        """
+        if not self.enabled:
+            return None
+        return time.time()
+
+    def observe_since(self, name, started, **labels):
+        if started is None or not self.enabled:
+            return
+        self.observe(name, time.time() - started, **labels)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        values = self._histograms.setdefault(name, {})
+        key = _key(labels)
+        h = values.get(key)
+        if h is None:
+            h = values[key] = [0] * len(BUCKETS) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                h[i] += 1
+                break
+        h[-1] += value
+
+    def gauge(self, name, fn):
+        """
+        Register fn, which returns a number or a list of (labels dict,
+        value) pairs, to be evaluated only when the metrics are rendered.
+        """
+        self._gauges[name] = fn
+
+    def _gauge_values(self, name):
+        v = self._gauges[name]()
+        if isinstance(v, list):
+            return dict((_key(labels), value) for (labels, value) in v)
+        return {(): v}
+
+    def render(self):
+        lines = []
+        def header(name, kind):
+            lines.append("# TYPE %s %s" % (name, kind))
+        for name in sorted(self._counters):
+            header(name, "counter")
+            for key, v in sorted(self._counters[name].items()):
+                lines.append("%s%s %s" % (name, _format_labels(key), v))
+        for name in sorted(self._gauges):
+            header(name, "gauge")
+            for key, v in sorted(self._gauge_values(name).items()):
+                lines.append("%s%s %s" % (name, _format_labels(key), v))
+        for name in sorted(self._histograms):
+            header(name, "histogram")
+            for key, h in sorted(self._histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (
+                        name, _format_labels(key, [("le", _format_value(bound))]),
+                        cumulative))
+                lines.append("%s_sum%s %s" % (name, _format_labels(key), h[-1]))
+                lines.append("%s_count%s %d" % (name, _format_labels(key),
+                                                cumulative))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        parts = []
+        for name in sorted(self._counters):
+            parts.append("%s=%s" % (name, sum(self._counters[name].values())))
+        for name in sorted(self._gauges):
+            parts.append("%s=%s" % (name,
+                                    sum(self._gauge_values(name).values())))
+        for name in sorted(self._histograms):
+            count = sum(sum(h[:-1]) for h in self._histograms[name].values())
+            total = sum(h[-1] for h in self._histograms[name].values())
+            if count:
+                parts.append("%s_avg=%.6f" % (name, total / count))
+        return " ".join(parts)
+
+metrics = Metrics()
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        Resource.__init__(self)
+        self._metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4")
+        return self._metrics.render().encode("utf-8")
+
+def makeMetricsService(port, interval, metrics=metrics):
+    """
+    Enable 'metrics' and return a service which serves them on the 'port'
+    endpoint (if any) and logs a summary every 'interval' seconds (if
+    non-zero).
+    """
+    parent = MultiService()
+    metrics.enabled = True
+    if port:
+        site = Site(MetricsResource(metrics))
+        strports.service(port, site).setServiceParent(parent)
+    if interval:
+        def summarize():
+            log.info("metrics: {summary}", summary=metrics.summary())
+        TimerService(interval, summarize).setServiceParent(parent)
+    return parent
@@ -20,6 +20,15 @@ class AddHostOptions(usage.Options):
     def parseArgs(self, host_name):
         self.host_name = host_name.decode("utf-8")
 
+class AddHostsOptions(usage.Options):
+    synopsis = "<hostname> [<hostname>..]"
+    longdesc = """The client may put all the hostnames (which must be in one zone)
+    on one certificate. A hostname like '*.sf.example.com' lets it get a
+    wildcard certificate, or one for any host in the zone."""
+    def parseArgs(self, host_name, *other_names):
+        self.host_name = host_name.decode("utf-8")
+        self.other_names = [n.decode("utf-8") for n in other_names]
+
 class Options(usage.Options):
     synopsis = "[options..]"
 
@@ -29,7 +38,7 @@ class Options(usage.Options):
 
     subCommands = [
         ("add-zone", None, AddZoneOptions, "Add a new DNS zone like sf.example.com"),
-        ("add-host", None, AddHostOptions, "Add a new hostname like printer.sf.example.com"),
+        ("add-host", None, AddHostsOptions, "Add a new hostname like printer.sf.example.com"),
         ("add-dyndns", None, AddHostOptions, "Add a new dyndns hostname like gw.sf.example.com"),
         ]
 
@@ -60,7 +69,7 @@ def run(reactor, opts):
 
     if opts.subCommand == "add-host":
         c = yield getController(reactor, controllerFurl)
-        furl = yield c.callRemote("add_host", so.host_name)
+        furl = yield c.callRemote("add_host", so.host_name, so.other_names)
         print("host '%s': %s" % (so.host_name, furl))
         w = wormhole.create(APPID, MAILBOX_URL, reactor)
         w.allocate_code()
@@ -0,0 +1,167 @@
+import math
+import attr
+from twisted.names import dns
+from ..eventlog import EventLog
+from ..metrics import metrics
+
+log = EventLog("flancer.server.expiry")
+
+# A client that crashes (or loses its connection) between start_responding
+# and stop_responding leaves its TXT record behind, so TXT records are given
+# a lifetime on the server, and each host and zone may only hold so many.
+# The lifetimes are kept in one timer wheel rather than a callLater per
+# record: a wheel costs O(1) to add, refresh or forget a deadline, and one
+# timer tick per second while anything is pending.
+
+@attr.s(cmp=False)
+class TimerWheel(object):
+    """
+    Call expire(key) once 'deadline' (see schedule) has passed, to within
+    one tick. Deadlines further away than slots*tick go round more than once.
+    """
+    _reactor = attr.ib()
+    _expire = attr.ib()
+    tick = attr.ib(default=1.0)
+    slots = attr.ib(default=1024)
+
+    def __attrs_post_init__(self):
+        self._slots = {} # slot index -> set of keys, possibly stale
+        self._deadlines = {} # key -> deadline, the authority on what is due
+        self._position = 0
+        self._next_tick = None
+        self._timer = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, key, deadline):
+        # a key already in the wheel is moved to a later deadline when its
+        # old slot comes round. An earlier one needs an earlier slot (the
+        # old slot entry is then stale).
+        if key not in self._deadlines or deadline < self._deadlines[key]:
+            self._insert(key, deadline)
+        self._deadlines[key] = deadline
+        if self._timer is None:
+            self._next_tick = self._reactor.seconds() + self.tick
+            self._timer = self._reactor.callLater(self.tick, self._advance)
+
+    def cancel(self, key):
+        # its slot entry is dropped when that slot comes round
+        self._deadlines.pop(key, None)
+
+    def _insert(self, key, deadline):
+        ticks = int(math.ceil((deadline - self._reactor.seconds()) / self.tick))
+        ticks = min(max(ticks, 1), self.slots - 1)
+        slot = (self._position + ticks) % self.slots
+        self._slots.setdefault(slot, set()).add(key)
+
+    def _advance(self):
+        self._timer = None
+        now = self._reactor.seconds()
+        # catch up on any ticks missed while the reactor was busy (one lap
+        # is enough: every key in it gets checked against its deadline)
+        for _ in range(self.slots):
+            if self._next_tick > now:
+                break
+            self._next_tick += self.tick
+            self._position = (self._position + 1) % self.slots
+            for key in self._slots.pop(self._position, ()):
+                deadline = self._deadlines.get(key)
+                if deadline is None:
+                    continue
+                if deadline <= now:
+                    del self._deadlines[key]
+                    self._expire(key)
+                else:
+                    self._insert(key, deadline)
+        self._next_tick = max(self._next_tick, now)
+        if self._deadlines:
+            self._timer = self._reactor.callLater(self._next_tick - now,
+                                                  self._advance)
+
+def _host_of(name):
+    # _acme-challenge.test1.sf.example.com -> test1.sf.example.com
+    return name.split(".", 1)[-1]
+
+@attr.s(cmp=False)
+class TXTRecordLimits(object):
+    _reactor = attr.ib()
+    lifetime = attr.ib(default=3600)
+    per_host = attr.ib(default=10)
+    per_zone = attr.ib(default=10000)
+
+    def __attrs_post_init__(self):
+        self._wheel = TimerWheel(self._reactor, self._expire)
+        self._authorities = {} # zone -> DynamicAuthority
+        self._hosts = {} # (zone, host) -> set of TXT names
+        self._zones = {} # zone -> number of TXT names
+
+    def check(self, zone, name, pending):
+        """
+        Return None if TXT record 'name' may be added to 'zone', else why
+        not. 'pending' counts the names already admitted in the same batch,
+        and is updated.
+        """
+        hk = (zone, _host_of(name))
+        if name in self._hosts.get(hk, ()):
+            return None # replacing one we have
+        if len(self._hosts.get(hk, ())) + pending.get(hk, 0) >= self.per_host:
+            metrics.inc("flancer_txt_rejected_total", limit="host")
+            return "too many TXT records for %s (limit %d)" % (hk[1],
+                                                              self.per_host)
+        if self._zones.get(zone, 0) + pending.get(zone, 0) >= self.per_zone:
+            metrics.inc("flancer_txt_rejected_total", limit="zone")
+            return "too many TXT records in %s (limit %d)" % (zone,
+                                                             self.per_zone)
+        pending[hk] = pending.get(hk, 0) + 1
+        pending[zone] = pending.get(zone, 0) + 1
+        return None
+
+    def changed_at(self, zone, name, when):
+        """
+        TXT record 'name' was really set at 'when' (e.g. before a restart),
+        so it expires 'lifetime' after that.
+        """
+        if name in self._hosts.get((zone, _host_of(name)), ()):
+            self._wheel.schedule((zone, name), when + self.lifetime)
+
+    def _expire(self, key):
+        (zone, name) = key
+        da = self._authorities.get(zone)
+        if da is None or name not in da.records:
+            return
+        log.info("TXT record {name} expired", name=name)
+        metrics.inc("flancer_txt_expired_total")
+        da.clearRecord(name)
+
+    # observer interface, see Server.add_observer
+
+    def zone_added(self, zone, da):
+        self._authorities[zone] = da
+        self.records_changed(zone, da, list(da.records))
+
+    def zone_removed(self, zone):
+        self._authorities.pop(zone, None)
+        for hk in [hk for hk in self._hosts if hk[0] == zone]:
+            for name in self._hosts.pop(hk):
+                self._wheel.cancel((zone, name))
+        self._zones.pop(zone, None)
+
+    def records_changed(self, zone, da, names):
+        self._authorities[zone] = da
+        deadline = self._reactor.seconds() + self.lifetime
+        for name in names:
+            hk = (zone, _host_of(name))
+            names_here = self._hosts.setdefault(hk, set())
+            if any(r.TYPE == dns.TXT for r in da.records.get(name, ())):
+                # each new value gets a full lifetime
+                if name not in names_here:
+                    names_here.add(name)
+                    self._zones[zone] = self._zones.get(zone, 0) + 1
+                self._wheel.schedule((zone, name), deadline)
+            elif name in names_here:
+                names_here.remove(name)
+                self._zones[zone] -= 1
+                self._wheel.cancel((zone, name))
+            if not names_here:
+                del self._hosts[hk]
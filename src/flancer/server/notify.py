@@ -0,0 +1,154 @@
+import random
+import socket
+import attr
+from twisted.application.service import Service
+from twisted.internet.defer import gatherResults, maybeDeferred
+from twisted.internet.protocol import DatagramProtocol
+from twisted.names import dns
+from ..eventlog import EventLog
+
+log = EventLog("flancer.server.notify")
+
+# Secondary nameservers poll our SOA every 'refresh' seconds, but a TXT
+# challenge is only useful if they pick it up right away. So after a zone
+# changes we send each configured secondary a NOTIFY (RFC 1996), which
+# makes it ask for an IXFR now. Changes within 'delay' of each other share
+# one NOTIFY, and a NOTIFY which is not acknowledged is resent a few times.
+# Only the main process sends them, even with --dns-workers.
+
+def canonical_address(host):
+    """
+    Return the usual text form of IP address 'host', which is how the
+    reactor reports peers (an IPv4-mapped IPv6 address becomes IPv4), or
+    raise ValueError if it is not an address.
+    """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, host)
+        except (socket.error, ValueError):
+            continue
+        if family == socket.AF_INET6 and packed[:12] == b"\0"*10 + b"\xff"*2:
+            family, packed = socket.AF_INET, packed[12:]
+        return socket.inet_ntop(family, packed)
+    raise ValueError("not an IP address: %r" % (host,))
+
+def parse_secondary(s):
+    """
+    Parse ADDR, ADDR:PORT or [IPV6]:PORT into (addr, port). Secondaries are
+    also let through --allow-transfer by address, so hostnames are refused.
+    """
+    if s.startswith("["):
+        host, _, port = s[1:].partition("]")
+        port = port.lstrip(":")
+    elif s.count(":") == 1:
+        host, port = s.split(":")
+    else:
+        host, port = s, ""
+    return (canonical_address(host), int(port or 53))
+
+class _NotifyProtocol(DatagramProtocol):
+    def __init__(self, notifier):
+        self._notifier = notifier
+
+    def datagramReceived(self, data, addr):
+        m = dns.Message()
+        try:
+            m.fromStr(data)
+        except Exception:
+            return
+        if m.answer and m.opCode == dns.OP_NOTIFY:
+            # IPv6 peers come with flow info and scope id too
+            self._notifier._acknowledged(m.id, (canonical_address(addr[0]),
+                                                addr[1]))
+
+@attr.s(cmp=False)
+class Notifier(Service, object):
+    _reactor = attr.ib()
+    _server = attr.ib()
+    secondaries = attr.ib() # [(host, port)]
+    delay = attr.ib(default=1.0)
+    retries = attr.ib(default=3)
+    retry_interval = attr.ib(default=5.0)
+
+    def __attrs_post_init__(self):
+        self._pending = {} # zone -> DelayedCall
+        self._unacked = {} # (id, (host, port)) -> (zone, tries, DelayedCall)
+        self._ports = {} # address family -> listening port
+
+    def startService(self):
+        Service.startService(self)
+        for family in set(self._family(host) for (host, _) in self.secondaries):
+            interface = "::" if family == socket.AF_INET6 else ""
+            self._ports[family] = self._reactor.listenUDP(
+                0, _NotifyProtocol(self), interface=interface)
+        self._server.add_observer(self)
+        # our serials start from the clock, so they have moved since the
+        # secondaries last looked
+        for zone in self._server.authorities():
+            self._changed(zone)
+
+    def stopService(self):
+        Service.stopService(self)
+        for c in list(self._pending.values()):
+            c.cancel()
+        for (_, _, c) in self._unacked.values():
+            c.cancel()
+        self._pending.clear()
+        self._unacked.clear()
+        ports, self._ports = list(self._ports.values()), {}
+        return gatherResults([maybeDeferred(p.stopListening) for p in ports])
+
+    def _family(self, host):
+        return socket.AF_INET6 if ":" in host else socket.AF_INET
+
+    # observer interface, see Server.add_observer
+
+    def zone_added(self, zone, da):
+        self._changed(zone)
+
+    def zone_removed(self, zone):
+        c = self._pending.pop(zone, None)
+        if c is not None:
+            c.cancel()
+
+    def records_changed(self, zone, da, names):
+        self._changed(zone)
+
+    def _changed(self, zone):
+        if self.running and zone not in self._pending:
+            self._pending[zone] = self._reactor.callLater(self.delay,
+                                                          self._notify, zone)
+
+    def _notify(self, zone):
+        del self._pending[zone]
+        for addr in self.secondaries:
+            self._send(zone, addr, 1)
+
+    def _send(self, zone, addr, tries):
+        m = dns.Message(id=random.randrange(1, 2**16), opCode=dns.OP_NOTIFY,
+                        auth=1)
+        m.queries = [dns.Query(zone, dns.SOA, dns.IN)]
+        try:
+            self._ports[self._family(addr[0])].write(m.toStr(), addr)
+        except Exception as e:
+            # e.g. no route: the retry may do better, and the other
+            # secondaries are still told
+            log.warn("unable to send NOTIFY for {zone} to {host}:{port}:"
+                     " {error}", zone=zone, host=addr[0], port=addr[1],
+                     error=e)
+        retry = self._reactor.callLater(self.retry_interval, self._retry,
+                                        m.id, addr)
+        self._unacked[(m.id, addr)] = (zone, tries, retry)
+
+    def _retry(self, id, addr):
+        (zone, tries, _) = self._unacked.pop((id, addr))
+        if tries >= self.retries:
+            log.warn("secondary {host}:{port} did not acknowledge NOTIFY"
+                     " for {zone}", host=addr[0], port=addr[1], zone=zone)
+            return
+        self._send(zone, addr, tries + 1)
+
+    def _acknowledged(self, id, addr):
+        entry = self._unacked.pop((id, addr), None)
+        if entry is not None:
+            entry[2].cancel()
@@ -0,0 +1,126 @@
+import json
+import attr
+from twisted.application.service import Service
+from twisted.names import dns
+from ..eventlog import EventLog
+from ..journal import write_atomically
+from .workers import encode_record, decode_record
+
+log = EventLog("flancer.server.persist")
+
+# The records clients set at runtime (dyndns addresses, TXT challenges) are
+# not part of config.json, so they used to be lost on restart, and every
+# gw.* name was NXDOMAIN until its client's canary reconnected. We snapshot
+# them to BASEDIR/records.json a moment after they change (one write per
+# burst of changes) and load them back before the DNS ports open. The apex
+# SOA and NS come from config.json and are not saved. TXT records older
+# than txt_lifetime (--txt-lifetime) are not restored, and the rest only
+# live out what is left of it.
+#
+# Each zone's SOA serial is saved too. The serial starts from the clock, but
+# a burst of changes can push it past the clock, and a restart soon after
+# would send it backwards: so it restarts from one past the saved serial if
+# that is ahead.
+
+@attr.s(cmp=False)
+class RecordStore(Service, object):
+    _reactor = attr.ib()
+    _fn = attr.ib() # FilePath of BASEDIR/records.json
+    _server = attr.ib()
+    delay = attr.ib(default=1.0)
+    txt_lifetime = attr.ib(default=3600)
+
+    def __attrs_post_init__(self):
+        self._changed = {} # (zone, name) -> when it last changed
+        self._pending = None
+
+    def startService(self):
+        Service.startService(self)
+        self.load()
+        self._server.add_observer(self)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._pending is not None:
+            self._pending.cancel()
+            self.save()
+
+    def load(self):
+        if not self._fn.exists():
+            return
+        try:
+            saved = json.loads(self._fn.getContent().decode("utf-8"))
+        except ValueError as e:
+            log.error("ignoring unreadable {fn}: {error}",
+                      fn=self._fn.path, error=e)
+            return
+        now = self._reactor.seconds()
+        authorities = self._server.authorities()
+        serials = saved.get("serials", {})
+        count = 0
+        for zone, names in saved["zones"].items():
+            if zone not in authorities:
+                continue
+            updates = {}
+            txt_names = []
+            for name, entry in names.items():
+                records = [decode_record(r) for r in entry["records"]]
+                if now - entry["changed"] > self.txt_lifetime:
+                    records = [r for r in records if r.TYPE != dns.TXT]
+                elif any(r.TYPE == dns.TXT for r in records):
+                    txt_names.append(name)
+                if records:
+                    updates[name] = records
+                    self._changed[(zone, name)] = entry["changed"]
+            authorities[zone].setRecords(updates)
+            count += len(updates)
+            if self._server.txt_limits is not None:
+                # setRecords gave them a whole new lifetime
+                for name in txt_names:
+                    self._server.txt_limits.changed_at(zone, name,
+                                                       names[name]["changed"])
+        for zone, serial in serials.items():
+            da = authorities.get(zone)
+            if da is not None and serial + 1 > da.soa[1].serial:
+                da.setRecords({}, serial=(serial + 1) % 2**32)
+        log.info("restored {count} names from {fn}", count=count,
+                 fn=self._fn.path)
+
+    def save(self):
+        self._pending = None
+        zones = {}
+        serials = {}
+        for zone, da in self._server.authorities().items():
+            serials[zone] = da.soa[1].serial
+            names = zones[zone] = {}
+            for name, records in da.records.items():
+                if name == zone:
+                    continue
+                names[name] = {"changed": self._changed.get((zone, name), 0),
+                               "records": [encode_record(r) for r in records]}
+        write_atomically(self._fn, json.dumps({"zones": zones,
+                                               "serials": serials}
+                                              ).encode("utf-8"))
+
+    def _dirty(self):
+        if self._pending is None and self.running:
+            self._pending = self._reactor.callLater(self.delay, self.save)
+
+    # observer interface, see Server.add_observer
+
+    def zone_added(self, zone, da):
+        pass
+
+    def zone_removed(self, zone):
+        for key in [key for key in self._changed if key[0] == zone]:
+            del self._changed[key]
+        self._dirty()
+
+    def records_changed(self, zone, da, names):
+        now = self._reactor.seconds()
+        for name in names:
+            if name in da.records:
+                self._changed[(zone, name)] = now
+            else:
+                self._changed.pop((zone, name), None)
+        self._dirty()
@@ -0,0 +1,87 @@
+import socket
+import attr
+
+# Response rate limiting, in the style of BIND's RRL. We are an
+# internet-facing authoritative server, so anyone can send us UDP queries
+# with a forged source address and have us reflect (larger) answers at the
+# victim. Each UDP response is charged against a token bucket for the
+# client's network prefix and the kind of response: one bucket per existing
+# name, one per zone for NXDOMAIN, and one for REFUSED (names outside every
+# zone). A resolver (e.g. Let's Encrypt's) asking for its _acme-challenge
+# name is therefore not starved by a flood of other names from the same
+# prefix.
+#
+# Once a bucket is empty, the responses are dropped, except every 'slip'th
+# one, which is sent as an empty truncated response: a real resolver behind
+# a forged flood retries over TCP, which is never limited because its source
+# address cannot be forged.
+
+OK, SLIP, DROP = "ok", "slip", "drop"
+
+_V4_MAPPED = b"\0" * 10 + b"\xff\xff" # ::ffff:0:0/96
+
+def source_prefix(host, ipv4_bits=24, ipv6_bits=56):
+    """
+    Return the network of 'host' (an address string) as a hashable key.
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    packed = bytearray(socket.inet_pton(family, host))
+    if family == socket.AF_INET6 and packed[:12] == _V4_MAPPED:
+        # an IPv4 client of a socket bound to '::'
+        family, packed = socket.AF_INET, packed[12:]
+    bits = ipv6_bits if family == socket.AF_INET6 else ipv4_bits
+    whole, rest = divmod(bits, 8)
+    if rest:
+        packed[whole] &= (0xff << (8 - rest)) & 0xff
+        whole += 1
+    return bytes(packed[:whole]) + b"/%d" % bits
+
+@attr.s(cmp=False)
+class ResponseRateLimiter(object):
+    _clock = attr.ib()
+    rate = attr.ib(default=20.0) # responses/sec per bucket
+    burst = attr.ib(default=None) # bucket size, default 2*rate
+    slip = attr.ib(default=2) # 0: drop every limited response
+    ipv4_bits = attr.ib(default=24)
+    ipv6_bits = attr.ib(default=56)
+    max_buckets = attr.ib(default=100000)
+
+    def __attrs_post_init__(self):
+        if self.burst is None:
+            self.burst = 2 * self.rate
+        self._buckets = {} # (prefix, kind) -> [tokens, updated, limited]
+
+    def check(self, host, kind):
+        """
+        Charge one response of 'kind' to 'host', and return OK (send it),
+        SLIP (send an empty truncated response instead) or DROP.
+        """
+        key = (source_prefix(host, self.ipv4_bits, self.ipv6_bits), kind)
+        now = self._clock.seconds()
+        b = self._buckets.get(key)
+        if b is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            b = self._buckets[key] = [self.burst, now, 0]
+        else:
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+        if b[0] >= 1:
+            b[0] -= 1
+            b[2] = 0
+            return OK
+        b[2] += 1
+        if self.slip and b[2] % self.slip == 0:
+            return SLIP
+        return DROP
+
+    def _prune(self, now):
+        # a bucket that has refilled is the same as no bucket at all
+        full = [key for (key, (tokens, updated, _)) in self._buckets.items()
+                if tokens + (now - updated) * self.rate >= self.burst]
+        for key in full:
+            del self._buckets[key]
+        if len(self._buckets) >= self.max_buckets:
+            # a flood from more prefixes than we can track: start over
+            # rather than grow without bound
+            self._buckets.clear()
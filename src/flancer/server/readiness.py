@@ -0,0 +1,81 @@
+import attr
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.internet.task import deferLater
+from twisted.names import client, dns
+from ..eventlog import EventLog
+
+log = EventLog("flancer.server.readiness")
+
+# Before we tell anyone a TXT record is in place (the zone test, or a client
+# about to ask the ACME server to validate), we ask the nameservers which
+# will be queried for it: our own DNS listener and any secondaries. (With
+# --dns-workers, a query to our port reaches just one of them, so instead
+# each worker reports what it is serving, see DNSWorkerPool.served.) Each
+# one is polled directly, in parallel, until it answers with the record or
+# 'timeout' passes. No recursion or caches are involved, so on a healthy
+# setup this takes a few milliseconds.
+
+def local_address(interface, port):
+    """
+    Where to reach our own DNS listener, which is bound to 'interface'.
+    """
+    if interface in ("", "0.0.0.0"):
+        return ("127.0.0.1", port)
+    if interface == "::":
+        return ("::1", port)
+    return (interface, port)
+
+@attr.s(cmp=False)
+class ReadinessChecker(object):
+    _reactor = attr.ib()
+    servers = attr.ib() # [(host, port)]
+    timeout = attr.ib(default=5.0)
+    interval = attr.ib(default=0.1)
+    query_timeout = attr.ib(default=0.5)
+
+    def __attrs_post_init__(self):
+        self._resolvers = dict((addr, client.Resolver(servers=[addr],
+                                                      reactor=self._reactor))
+                               for addr in self.servers)
+
+    def check(self, name, data):
+        """
+        Return a Deferred that fires with None once every server answers
+        'name' with a TXT record holding 'data', or with a description of
+        the servers which did not before the timeout.
+        """
+        deadline = self._reactor.seconds() + self.timeout
+        d = gatherResults([self._poll(addr, name, data, deadline)
+                           for addr in self.servers])
+        def _summarize(problems):
+            problems = ["%s:%d %s" % (addr[0], addr[1], problem)
+                        for (addr, problem) in zip(self.servers, problems)
+                        if problem]
+            if problems:
+                log.warn("{name} is not being served: {problems}",
+                         name=name, problems=problems)
+                return "%s is not being served by %s" % (name,
+                                                        ", ".join(problems))
+            return None
+        d.addCallback(_summarize)
+        return d
+
+    @inlineCallbacks
+    def _poll(self, addr, name, data, deadline):
+        resolver = self._resolvers[addr]
+        while True:
+            remaining = deadline - self._reactor.seconds()
+            try:
+                (answers, _, _) = yield resolver.lookupText(
+                    name, timeout=(max(0.01, min(remaining,
+                                                 self.query_timeout)),))
+            except Exception as e:
+                problem = "(%s)" % (e.__class__.__name__,)
+            else:
+                if any(rr.type == dns.TXT and data in rr.payload.data
+                       for rr in answers):
+                    returnValue(None)
+                problem = "(wrong TXT data)"
+            if self._reactor.seconds() + self.interval >= deadline:
+                returnValue(problem)
+            yield deferLater(self._reactor, self.interval, lambda: None)
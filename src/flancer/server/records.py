@@ -0,0 +1,134 @@
+import sys
+import struct
+from io import BytesIO
+try:
+    from collections.abc import MutableMapping
+except ImportError: # py2
+    from collections import MutableMapping
+from twisted.names import dns
+
+# A zone with tens of thousands of hosts and dyndns names holds mostly A,
+# AAAA and TXT records, and a Record_* object (with its __dict__, its list,
+# and the full name it is filed under) costs several hundred bytes. So each
+# DynamicAuthority keeps its records in a CompactRecords instead: names are
+# stored relative to the zone and interned, and A/AAAA/TXT records are
+# packed into one bytes object each (type, ttl, then the DNS wire format
+# rdata). Record_* objects are only built when a name is read, i.e. when a
+# query misses the answer cache, or for a transfer. Other record types (the
+# apex SOA and NS, which must stay the same objects) are kept as they are.
+
+try:
+    _intern = sys.intern
+except AttributeError: # py2
+    _intern = intern
+
+_COMPACT = {dns.A: dns.Record_A, dns.AAAA: dns.Record_AAAA,
+            dns.TXT: dns.Record_TXT}
+_HEADER = struct.Struct("!HI")
+_NO_TTL = 0xffffffff
+
+def _pack(record):
+    buf = BytesIO()
+    record.encode(buf, None)
+    ttl = _NO_TTL if record.ttl is None else record.ttl
+    return _HEADER.pack(record.TYPE, ttl) + buf.getvalue()
+
+def _unpack(packed):
+    (type, ttl) = _HEADER.unpack_from(packed)
+    rdata = packed[_HEADER.size:]
+    record = _COMPACT[type]()
+    record.decode(BytesIO(rdata), len(rdata))
+    record.ttl = None if ttl == _NO_TTL else ttl
+    return record
+
+class CompactRecords(MutableMapping):
+    """
+    A dict of name -> list of Record_* for one zone, as FileAuthority wants
+    in .records, which stores the records compactly. Each read builds a new
+    list, so change a name by assigning a new list to it.
+    """
+    def __init__(self, zone, records={}):
+        self._zone = zone
+        self._suffix = "." + zone
+        # relative name -> packed bytes (one record), tuple of packed bytes,
+        # or a list of Record_* objects
+        self._names = {}
+        self.update(records)
+
+    def _relative(self, name):
+        # FileAuthority looks some names up as bytes (e.g. NS targets, for
+        # the additional section)
+        if isinstance(name, bytes):
+            try:
+                name = name.decode("ascii")
+            except UnicodeDecodeError:
+                return None
+        if name == self._zone:
+            return ""
+        if name.endswith(self._suffix):
+            relative = name[:-len(self._suffix)]
+            # "", ".x", "x." or "x..y" would have an empty label: an empty
+            # one would also alias the apex
+            if (not relative or relative[0] == "." or relative[-1] == "."
+                or ".." in relative):
+                return None
+            return relative
+        return None
+
+    def _absolute(self, relative):
+        return "%s%s" % (relative, self._suffix) if relative else self._zone
+
+    def __getitem__(self, name):
+        stored = self._names.get(self._relative(name))
+        if stored is None:
+            raise KeyError(name)
+        if isinstance(stored, list):
+            return stored
+        if isinstance(stored, tuple):
+            return [_unpack(packed) for packed in stored]
+        return [_unpack(stored)]
+
+    def __setitem__(self, name, records):
+        relative = self._relative(name)
+        if relative is None:
+            raise KeyError("%s is not in zone %s" % (name, self._zone))
+        if not all(r.TYPE in _COMPACT for r in records):
+            stored = list(records)
+        elif len(records) == 1:
+            stored = _pack(records[0])
+        else:
+            stored = tuple(_pack(r) for r in records)
+        self._names[_intern(relative)] = stored
+
+    def __delitem__(self, name):
+        if self._names.pop(self._relative(name), None) is None:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return self._relative(name) in self._names
+
+    def __iter__(self):
+        for relative in self._names:
+            yield self._absolute(relative)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __repr__(self):
+        # builds every record, so only for debugging (see _dump)
+        return "CompactRecords(%r, %r)" % (self._zone, dict(self.items()))
+
+    def count(self, type):
+        """
+        How many records of 'type' we hold, without building any.
+        """
+        n = 0
+        for stored in self._names.values():
+            if isinstance(stored, list):
+                n += sum(1 for r in stored if r.TYPE == type)
+            elif isinstance(stored, tuple):
+                n += sum(1 for packed in stored
+                         if _HEADER.unpack_from(packed)[0] == type)
+            elif _HEADER.unpack_from(stored)[0] == type:
+                n += 1
+        return n
@@ -1,24 +1,40 @@
 from __future__ import print_function
 import os
+import copy
+import time
+from collections import deque
+import socket
 import attr
-import json
-from operator import methodcaller
 from twisted.internet import reactor
 from twisted.python import usage
 from twisted.python.filepath import FilePath
 from twisted.application.service import MultiService
 from twisted.application.internet import UDPServer, TCPServer
 #from twisted.application.internet import TimerService
+from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import gatherResults
 from twisted.internet.address import IPv4Address, IPv6Address
 #from twisted.names import tap, authority, dns, resolve
+from twisted.python.compat import nativeString
+from twisted.python.failure import Failure
 from twisted.names.server import DNSServerFactory
-from twisted.names import authority, dns
-from twisted.names.resolve import ResolverChain
-from twisted.names import client as dns_client
-from twisted.names.error import DNSNameError
+from twisted.names import authority, common, dns
+from twisted.names.error import DomainError
 from foolscap.api import Tub, Referenceable
 from foolscap.appserver.cli import make_swissnum
+from twisted.logger import LogLevel
+from ..eventlog import EventLog, parse_level
+from ..journal import JournaledDict
+from ..metrics import metrics, makeMetricsService
+from .workers import DNSWorkerPool
+from . import ratelimit
+from .notify import Notifier, parse_secondary, canonical_address
+from .readiness import ReadinessChecker, local_address
+from .persist import RecordStore
+from .expiry import TXTRecordLimits
+from .records import CompactRecords
+from .watch import ChallengeWatch
 
 LONGDESC = """\
 Respond to ACME dns-01 challenges (TXT records).
@@ -34,74 +50,431 @@ class Options(usage.Options):
         ("dns-interface", None, "", "Interface to which to bind the DNS server ports"),
         ("foolscap-port", None, "tcp:6318", "port (endpoint string) for the Foolscap server"),
         ("hostname", None, None, "hostname (required) for the Foolscap port)"),
+        ("dns-workers", None, "0", "number of worker processes to answer DNS, all sharing --dns-port via SO_REUSEPORT (0: answer in this process)"),
+        ("rate-limit", None, "20", "UDP responses/sec to each client /24 (IPv6: /56) for any one name, NXDOMAIN zone, or refused query; 0 to disable"),
+        ("rate-limit-slip", None, "2", "answer every Nth rate-limited query with an empty truncated response (so real clients retry over TCP); 0 to drop them all"),
+        ("allow-transfer", None, "", "comma-separated addresses allowed to transfer zones (AXFR/IXFR), in addition to the --notify secondaries"),
+        ("notify", None, "", "comma-separated secondary nameservers (HOST, HOST:PORT, [IPV6]:PORT) to send a NOTIFY when a zone changes"),
+        ("ready-timeout", None, "5", "seconds to wait for a new TXT record to be served by our DNS port and the --notify secondaries, before the zone test or a client's challenge fails"),
+        ("txt-lifetime", None, "3600", "seconds after which a TXT record that was never deleted (e.g. by a client that crashed mid-challenge) is removed"),
+        ("max-txt-per-host", None, "10", "most TXT records one hostname may hold at once"),
+        ("max-txt-per-zone", None, "10000", "most TXT records one zone may hold at once"),
+        ("log-level", None, "info", "minimum level for DNS/record events: debug (traces every query), info, warn, error"),
+        ("metrics-port", None, None, "endpoint (e.g. tcp:9100:interface=127.0.0.1) on which to serve Prometheus metrics"),
+        ("metrics-log-interval", None, "0", "seconds between metrics summaries in the log, 0 to disable"),
         ]
 
     def postOptions(self):
         if not self["hostname"]:
             raise usage.UsageError("--hostname= is required: how should the client contact this server?")
+        try:
+            parse_level(self["log-level"])
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+        try:
+            if float(self["rate-limit"]) < 0 or int(self["rate-limit-slip"]) < 0:
+                raise ValueError
+        except ValueError:
+            raise usage.UsageError("--rate-limit and --rate-limit-slip must be non-negative numbers")
+        try:
+            self.secondaries = [parse_secondary(s)
+                                for s in self["notify"].split(",") if s]
+        except ValueError:
+            raise usage.UsageError("--notify= wants IP addresses: ADDR, ADDR:PORT or [IPV6]:PORT")
+        try:
+            self.allow_transfer = [canonical_address(a) for a in
+                                   self["allow-transfer"].split(",") if a]
+        except ValueError:
+            raise usage.UsageError("--allow-transfer= wants IP addresses")
+        if int(self["dns-workers"]) and not hasattr(socket, "SO_REUSEPORT"):
+            raise usage.UsageError("--dns-workers needs SO_REUSEPORT, which this platform lacks")
+
+# per-query and per-mutation events go through here, not print()
+log = EventLog("flancer.server")
 
 def extract_zone(name):
     return name.split(".", 1)[1]
 
+def covers(grant, hostname):
+    """
+    Does a client granted 'grant' (a hostname, or *.ZONE for every host in
+    the zone) get to set challenges for 'hostname'? A wildcard certificate
+    is validated at the zone itself, so *.ZONE covers ZONE too.
+    """
+    if grant.startswith("*."):
+        zone = grant[2:]
+        return hostname == zone or hostname.split(".", 1)[-1] == zone
+    return hostname == grant
+
+def valid_txtname(txtname):
+    """
+    Is 'txtname' one DNS label (like _acme-challenge), so the TXT record
+    goes directly below the client's hostname? An empty one, or one with
+    dots, could reach the zone's own SOA/NS records or someone else's name.
+    """
+    return (isinstance(txtname, str) and 0 < len(txtname) <= 63
+            and "." not in txtname)
+
 # we want something very similar to a FileAuthority, but with some
 # dynamically-generated records
 
 class DynamicAuthority(authority.FileAuthority):
+    # answers are cached until the next mutation, but a flood of queries for
+    # distinct (or randomly-cased) names should not grow the cache forever
+    ANSWER_CACHE_LIMIT = 10000
+
+    # IXFR can bring a secondary up to date from this many changes ago,
+    # secondaries further behind are sent the whole zone
+    JOURNAL_LIMIT = 100
+
     def __init__(self, zone, soa, initial_records={}):
         authority.FileAuthority.__init__(self, None)
         self.soa = (zone, soa)
-        self.records = initial_records
+        self.records = CompactRecords(zone, initial_records)
+        self._answers = {} # (name, cls, type) -> (ans, auth, add)
+        # (old serial, new serial, removed, added), removed and added being
+        # lists of (name, record)
+        self._journal = deque(maxlen=self.JOURNAL_LIMIT)
+        # told records_changed(zone, authority, names) after every mutation
+        self.observers = []
     def loadFile(self, _):
         pass
 
     def _dump(self):
-        print("records[%s] are now %s" % (self.soa[0], self.records))
+        log.debug("records[{zone}] are now {records}",
+                  zone=self.soa[0], records=self.records)
+
+    def _replace(self, updates, serial=None):
+        # every mutation comes through here: 'updates' maps each changed
+        # name to its new records (empty to delete the name). The SOA serial
+        # goes up by one (or to 'serial', for a copy of another authority)
+        # and the difference is journaled for IXFR.
+        removed, added = [], []
+        for name, records in updates.items():
+            old = self.records.get(name, [])
+            removed.extend((name, r) for r in old if r not in records)
+            added.extend((name, r) for r in records if r not in old)
+            if records:
+                self.records[name] = list(records)
+            else:
+                self.records.pop(name, None)
+        if not (removed or added) and serial is None:
+            return
+        soa = self.soa[1]
+        old_serial = soa.serial
+        soa.serial = serial if serial is not None else (old_serial + 1) % 2**32
+        self._journal.append((old_serial, soa.serial, removed, added))
+        # any change can affect other names' answers (additional A records
+        # for an in-zone NS, the SOA in negative answers), so drop them all
+        self._answers.clear()
+        self._dump()
+        for o in self.observers:
+            o.records_changed(self.soa[0], self, list(updates))
 
     def setTXT(self, hostname, txtname, data):
         assert type(data) is type(b""), (type(data), data)
         # hostname is like 'test1.sf.example.com'
-        print("setTXT", hostname, txtname, data)
+        log.info("setTXT {hostname} {txtname} {data}",
+                 hostname=hostname, txtname=txtname, data=data)
         fullname = "%s.%s" % (txtname, hostname)
-        self.records[fullname] = [dns.Record_TXT(data, ttl=5)]
-        self._dump()
+        self._replace({fullname: [dns.Record_TXT(data, ttl=5)]})
 
     def deleteTXT(self, hostname, txtname):
-        print("deleteTXT", hostname, txtname)
+        log.info("deleteTXT {hostname} {txtname}",
+                 hostname=hostname, txtname=txtname)
         fullname = "%s.%s" % (txtname, hostname)
-        del self.records[fullname]
-        self._dump()
+        self.records[fullname] # KeyError if missing
+        self._replace({fullname: []})
+
+    def updateTXTs(self, changes):
+        """
+        Apply a batch of (hostname, txtname, data) changes, where data=None
+        deletes the record, and return a (ok, error) tuple for each one.
+        """
+        results = []
+        updates = {}
+        for (hostname, txtname, data) in changes:
+            fullname = "%s.%s" % (txtname, hostname)
+            if data is None:
+                if not updates.get(fullname, self.records.get(fullname)):
+                    results.append((False, "no TXT record for %s" % fullname))
+                    continue
+                updates[fullname] = []
+            elif type(data) is not type(b""):
+                results.append((False, "TXT data must be bytes"))
+                continue
+            else:
+                updates[fullname] = [dns.Record_TXT(data, ttl=5)]
+            results.append((True, None))
+        log.info("updateTXTs {count} changes in {zone}",
+                 count=len(changes), zone=self.soa[0])
+        self._replace(updates)
+        return results
 
     def setRecord(self, hostname, record):
-        self.records[hostname] = [record]
-        self._dump()
+        log.info("setRecord {hostname} {record}",
+                 hostname=hostname, record=record)
+        self._replace({hostname: [record]})
 
     def clearRecord(self, hostname):
-        del self.records[hostname]
-        self._dump()
+        log.info("clearRecord {hostname}", hostname=hostname)
+        self.records[hostname] # KeyError if missing
+        self._replace({hostname: []})
+
+    def setRecords(self, updates, serial=None):
+        """
+        Replace the records of each name in 'updates' (removing names whose
+        list is empty), and set the SOA serial to 'serial' if given.
+        """
+        self._replace(updates, serial)
+
+    def _rr(self, name, record):
+        ttl = record.ttl
+        if ttl is None:
+            ttl = max(self.soa[1].minimum, self.soa[1].expire)
+        return dns.RRHeader(name, record.TYPE, dns.IN, ttl, record, auth=True)
+
+    def _soa_rr(self, serial=None):
+        soa = self.soa[1]
+        if serial is not None:
+            soa = copy.copy(soa)
+            soa.serial = serial
+        return self._rr(self.soa[0], soa)
+
+    def lookupZone(self, name, timeout=None):
+        # AXFR. FileAuthority's version compares our native-string zone with
+        # a bytes name, so it never matches on py3
+        if name.lower().rstrip(".") != self.soa[0].lower():
+            return defer.fail(Failure(dns.DomainError(name)))
+        answers = [self._soa_rr()]
+        for name, records in self.records.items():
+            answers.extend(self._rr(name, r) for r in records
+                           if r.TYPE != dns.SOA)
+        answers.append(answers[0])
+        return defer.succeed((answers, [], []))
+
+    def lookupIncremental(self, name, serial):
+        """
+        Answer an IXFR (RFC 1995) from a secondary which has 'serial': the
+        journaled changes since then, or the whole zone if the journal does
+        not reach back that far. With serial=None, or when the secondary is
+        up to date, the answer is just the current SOA.
+        """
+        if name.lower().rstrip(".") != self.soa[0].lower():
+            return defer.fail(Failure(dns.DomainError(name)))
+        if serial is None or serial == self.soa[1].serial:
+            return defer.succeed(([self._soa_rr()], [], []))
+        journal = list(self._journal)
+        starts = [old for (old, new, removed, added) in journal]
+        if serial not in starts:
+            return self.lookupZone(name)
+        answers = [self._soa_rr()]
+        for (old, new, removed, added) in journal[starts.index(serial):]:
+            answers.append(self._soa_rr(old))
+            answers.extend(self._rr(n, r) for (n, r) in removed)
+            answers.append(self._soa_rr(new))
+            answers.extend(self._rr(n, r) for (n, r) in added)
+        answers.append(self._soa_rr())
+        return defer.succeed((answers, [], []))
 
     def _lookup(self, name, cls, type, timeout = None):
-        print("LOOKUP: %s %s %s" % (name, dns.QUERY_CLASSES.get(cls, cls),
-                                    dns.QUERY_TYPES.get(type, type)))
-        d = authority.FileAuthority._lookup(self, name, cls, type, timeout)
-        def _log(res):
-            print("-> %s" % (res,))
-            return res
-        d.addBoth(_log)
+        tracing = log.enabled(LogLevel.debug)
+        if tracing:
+            log.debug("LOOKUP: {name} {cls} {type}", name=name,
+                      cls=dns.QUERY_CLASSES.get(cls, cls),
+                      type=dns.QUERY_TYPES.get(type, type))
+        started = metrics.start()
+        key = (name, cls, type)
+        cached = self._answers.get(key)
+        if cached is not None:
+            result = "cached"
+            d = defer.succeed(tuple(list(section) for section in cached))
+        elif name.lower() not in self.records:
+            # ZoneResolver only sends us names inside our zone, so a missing
+            # name is NXDOMAIN without FileAuthority's subdomain check (which
+            # also wants bytes, and our names are native strings)
+            result = "nxdomain"
+            d = defer.fail(Failure(dns.AuthoritativeDomainError(name)))
+        else:
+            result = "hit"
+            d = authority.FileAuthority._lookup(self, name, cls, type, timeout)
+            # FileAuthority answers synchronously. Only positive answers are
+            # cached: NXDOMAIN names are unbounded and cheap to compute.
+            def _cache(res):
+                if len(self._answers) >= self.ANSWER_CACHE_LIMIT:
+                    self._answers.clear()
+                self._answers[key] = tuple(list(section) for section in res)
+                return res
+            d.addCallback(_cache)
+        metrics.inc("flancer_dns_queries_total", zone=self.soa[0],
+                    result=result)
+        metrics.observe_since("flancer_dns_lookup_seconds", started,
+                              zone=self.soa[0])
+        if tracing:
+            def _log(res):
+                log.debug("-> {result}", result=res)
+                return res
+            d.addBoth(_log)
         return d
 
-@attr.s
-class Data(dict):
-    _fn = attr.ib(converter=methodcaller('asTextMode')) # BASEDIR/config.json
+class NotInZones(DomainError):
+    """
+    The queried name is not inside any zone we are authoritative for.
+    """
+
+class ZoneResolver(common.ResolverBase):
+    """
+    Route each query to the DynamicAuthority that owns it, by finding the
+    longest registered zone which is a suffix of the query name. This costs
+    one dict lookup per label, no matter how many zones we serve, whereas a
+    ResolverChain asks every authority in turn.
+    """
+    def __init__(self, authorities={}):
+        common.ResolverBase.__init__(self)
+        self._zones = {} # lowercase zone name -> DynamicAuthority
+        for zone, da in authorities.items():
+            self.addZone(zone, da)
+
+    def addZone(self, zone, da):
+        self._zones[zone.lower().rstrip(".")] = da
+
+    def removeZone(self, zone):
+        self._zones.pop(zone.lower().rstrip("."), None)
+
+    def authorityFor(self, name):
+        labels = nativeString(name).lower().rstrip(".").split(".")
+        for i in range(len(labels)):
+            da = self._zones.get(".".join(labels[i:]))
+            if da is not None:
+                return da
+        return None
+
+    def _lookup(self, name, cls, type, timeout=None):
+        da = self.authorityFor(name)
+        if da is None:
+            metrics.inc("flancer_dns_queries_total", zone="", result="refused")
+            return defer.fail(Failure(NotInZones(name)))
+        return da._lookup(nativeString(name), cls, type, timeout)
+
+    def lookupZone(self, name, timeout=None):
+        da = self.authorityFor(name)
+        if da is None:
+            return defer.fail(Failure(NotInZones(name)))
+        return da.lookupZone(nativeString(name), timeout)
+
+    def lookupIncremental(self, name, serial):
+        da = self.authorityFor(name)
+        if da is None:
+            return defer.fail(Failure(NotInZones(name)))
+        return da.lookupIncremental(nativeString(name), serial)
+
+class FlancerDNSServerFactory(DNSServerFactory):
+    """
+    We are only an authoritative server, so queries for names outside our
+    zones are REFUSED rather than answered with NXDOMAIN.
+
+    With a ResponseRateLimiter in .limiter, UDP queries are classified and
+    charged before any lookup happens, so a flood is shed (or slipped)
+    without reaching the resolver, and out-of-zone names are refused here
+    directly.
+
+    Zone transfers (AXFR, and IXFR from the journal of recent changes) are
+    only answered for addresses in .allow_transfer.
+    """
+    limiter = None
+    allow_transfer = frozenset()
+    # called with (name, client address) for each TXT query
+    query_observer = None
+
+    def configure(self, reactor, rate_limit=None, allow_transfer=()):
+        """
+        Apply the settings shared with --dns-workers processes:
+        ResponseRateLimiter kwargs, and the addresses allowed to transfer.
+        """
+        if rate_limit:
+            self.limiter = ratelimit.ResponseRateLimiter(reactor, **rate_limit)
+        self.allow_transfer = frozenset(allow_transfer)
+
+    def handleQuery(self, message, protocol, address):
+        query = message.queries[0]
+        if query.type not in (dns.AXFR, dns.IXFR):
+            if query.type == dns.TXT and self.query_observer is not None:
+                host = (address[0] if address
+                        else protocol.transport.getPeer().host)
+                self.query_observer(nativeString(query.name.name).lower(),
+                                    host)
+            return DNSServerFactory.handleQuery(self, message, protocol,
+                                                address)
+        host = address[0] if address else protocol.transport.getPeer().host
+        if canonical_address(host) not in self.allow_transfer:
+            log.warn("refusing zone transfer of {zone} to {host}",
+                     zone=query.name, host=host)
+            self.sendReply(protocol, self._responseFromMessage(
+                message=message, rCode=dns.EREFUSED), address)
+            return
+        if query.type == dns.AXFR:
+            return DNSServerFactory.handleQuery(self, message, protocol,
+                                                address)
+        # the secondary puts the SOA it has in the authority section
+        serial = None
+        for rr in message.authority:
+            if rr.type == dns.SOA:
+                serial = rr.payload.serial
+        if address is not None:
+            # over UDP, where the changes might not fit, the current SOA
+            # tells the secondary to ask again over TCP
+            serial = None
+        d = self.resolver.lookupIncremental(query.name.name, serial)
+        d.addCallback(self.gotResolverResponse, protocol, message, address)
+        d.addErrback(self.gotResolverError, protocol, message, address)
+        return d
 
-    def __attrs_post_init__(self):
-        if not self._fn.isfile():
-            self["zones"] = {}
-            self._fn.setContent(json.dumps(self).encode("utf-8")+"\n")
-        for k,v in json.loads(self._fn.getContent().decode("utf-8")).items():
-            self[k] = v
+    def messageReceived(self, message, proto, address=None):
+        if (address is None or self.limiter is None or message.answer
+            or message.opCode != dns.OP_QUERY or len(message.queries) != 1):
+            return DNSServerFactory.messageReceived(self, message, proto,
+                                                    address)
+        message.timeReceived = time.time() # for sendReply
+        name = nativeString(message.queries[0].name.name).lower()
+        da = self.resolver.authorityFor(name)
+        if da is None:
+            kind = "refused"
+        elif name in da.records:
+            kind = name
+        else:
+            kind = "nxdomain " + da.soa[0]
+        action = self.limiter.check(address[0], kind)
+        if action == ratelimit.OK:
+            if da is None:
+                metrics.inc("flancer_dns_queries_total", zone="",
+                            result="refused")
+                self.sendReply(proto, self._responseFromMessage(
+                    message=message, rCode=dns.EREFUSED), address)
+                return
+            return DNSServerFactory.messageReceived(self, message, proto,
+                                                    address)
+        metrics.inc("flancer_dns_ratelimited_total", action=action)
+        log.warn("rate limiting responses to {host}", host=address[0])
+        if action == ratelimit.SLIP:
+            response = self._responseFromMessage(message=message)
+            response.trunc = 1
+            self.sendReply(proto, response, address)
+
+    def gotResolverError(self, failure, protocol, message, address):
+        if failure.check(NotInZones):
+            response = self._responseFromMessage(message=message,
+                                                 rCode=dns.EREFUSED)
+            self.sendReply(protocol, response, address)
+            return
+        return DNSServerFactory.gotResolverError(self, failure, protocol,
+                                                 message, address)
+
+@attr.s
+class Data(JournaledDict):
+    # BASEDIR/config.json, plus BASEDIR/config.json.journal
 
-    def save(self):
-        self._fn.setContent(json.dumps(self).encode("utf-8")+"\n")
+    def initial(self):
+        return {"zones": {}}
 
 @attr.s(cmp=False)
 class DyndnsController(Referenceable, object):
@@ -120,8 +493,10 @@ class DyndnsController(Referenceable, object):
             return
         print("setting dyndns record: %s %s" % (self._hostname, record))
         self._server.set_dyndns(self._hostname, record)
+        self._server.canary_connected(self._hostname)
         def disconnected():
             print("canary lost (%s = %s)" % (self._hostname, record))
+            self._server.canary_lost(self._hostname)
         canary.notifyOnDisconnect(disconnected)
 
 
@@ -129,13 +504,74 @@ class DyndnsController(Referenceable, object):
 class HostController(Referenceable, object):
     _hostname = attr.ib()
     _server = attr.ib()
+    # every name the client may get certificates for, see covers()
+    _names = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        if self._names is None:
+            self._names = [self._hostname]
+
+    def _allowed(self, hostname):
+        return any(covers(grant, hostname) for grant in self._names)
 
     def remote_get_hostname(self):
+        metrics.inc("flancer_foolscap_calls_total", method="get_hostname")
         return self._hostname # e.g. test1.sf.example.com
+    def remote_get_names(self):
+        metrics.inc("flancer_foolscap_calls_total", method="get_names")
+        return self._names # e.g. [test1.sf.example.com, *.sf.example.com]
+    def _check_txtname(self, txtname):
+        if not valid_txtname(txtname):
+            raise ValueError("invalid TXT name %r" % (txtname,))
     def remote_set_txt(self, txtname, data):
+        metrics.inc("flancer_foolscap_calls_total", method="set_txt")
+        self._check_txtname(txtname)
         self._server.add_txt(self._hostname, txtname, data)
     def remote_delete_txt(self, txtname):
+        metrics.inc("flancer_foolscap_calls_total", method="delete_txt")
+        self._check_txtname(txtname)
         self._server.delete_txt(self._hostname, txtname)
+    def _refusals(self, changes):
+        # None for each change this client may make
+        results = []
+        for (hostname, txtname, data) in changes:
+            if not self._allowed(hostname):
+                results.append((False, "not authorized for %s" % hostname))
+            elif not valid_txtname(txtname):
+                results.append((False, "invalid TXT name %r" % (txtname,)))
+            else:
+                results.append(None)
+        return results
+    def remote_update_txts(self, changes):
+        metrics.inc("flancer_foolscap_calls_total", method="update_txts")
+        # changes is a list of (hostname, txtname, data), data=None to delete
+        results = self._refusals(changes)
+        allowed = [i for (i, r) in enumerate(results) if r is None]
+        applied = self._server.update_txts([changes[i] for i in allowed])
+        for i, r in zip(allowed, applied):
+            results[i] = r
+        return results
+    def remote_subscribe(self, observer):
+        metrics.inc("flancer_foolscap_calls_total", method="subscribe")
+        # observer.callRemote("challenge_queried", name, resolver, age) is
+        # called when resolvers look up our challenge records
+        if self._server.challenges is None:
+            return False
+        self._server.challenges.subscribe(self._names, observer)
+        return True
+    def remote_confirm_txts(self, changes):
+        metrics.inc("flancer_foolscap_calls_total", method="confirm_txts")
+        # changes is a list of (hostname, txtname, data) that update_txts
+        # set: fires once they are being served, see Server.confirm_txts
+        results = self._refusals(changes)
+        allowed = [i for (i, r) in enumerate(results) if r is None]
+        d = self._server.confirm_txts([changes[i] for i in allowed])
+        def _merge(confirmed):
+            for i, r in zip(allowed, confirmed):
+                results[i] = r
+            return results
+        d.addCallback(_merge)
+        return d
 
 
 @attr.s(cmp=False)
@@ -144,45 +580,77 @@ class Controller(Referenceable, object):
     _server = attr.ib()
     _furl_prefix = None
 
+    def __attrs_post_init__(self):
+        # swissnum -> HostController/DyndnsController. Foolscap calls
+        # lookup() for every reference resolution, so we keep this index in
+        # sync with self._data rather than scanning every zone each time.
+        self._controllers = {}
+        for z, zd in self._data["zones"].items():
+            # (hostname, swissnum), or (hostname, swissnum, names) for a
+            # client granted more than one name
+            for entry in zd["hostname_swissnums"]:
+                names = entry[2] if len(entry) > 2 else None
+                self._add_controller(entry[1],
+                                     HostController(entry[0], self._server,
+                                                    names))
+        for (hostname, swissnum) in self._data.get("dyndns", {}).items():
+            self._add_controller(swissnum,
+                                 DyndnsController(hostname, self._server))
+
+    def _add_controller(self, swissnum, controller):
+        self._controllers[swissnum] = controller
+
     def set_furl_prefix(self, furl_prefix):
         self._furl_prefix = furl_prefix
 
     def lookup(self, name):
-        for z, zd in self._data["zones"].items():
-            for (hostname, swissnum) in zd["hostname_swissnums"]:
-                if swissnum == name:
-                    return HostController(hostname, self._server)
-        for (hostname, swissnum) in self._data.get("dyndns", []).items():
-            if swissnum == name:
-                return DyndnsController(hostname, self._server)
+        return self._controllers.get(name)
 
     @inlineCallbacks
     def remote_add_zone(self, zone_name, server_name):
+        metrics.inc("flancer_foolscap_calls_total", method="add_zone")
         assert isinstance(zone_name, type(u""))
         assert isinstance(server_name, type(u""))
         print(self._data["zones"])
         if zone_name in self._data["zones"]:
             print("already present")
             returnValue("already present")
-        self._data["zones"][zone_name] = { "server_name": server_name,
-                                           "hostname_swissnums": [], # tuples of (hostname, swissnum)
-                                           }
-        self._server.update_records()
+        zd = { "server_name": server_name,
+               "hostname_swissnums": [], # tuples of (hostname, swissnum)
+               }
+        # the authority is built from self._data, but the zone is only
+        # recorded on disk once the test passes
+        self._data["zones"][zone_name] = zd
+        self._server.add_zone(zone_name)
         try:
             yield self._server.test_zone(zone_name)
         except:
             del self._data["zones"][zone_name]
+            self._server.remove_zone(zone_name)
             raise
-        self._data.save()
+        self._data.set(["zones", zone_name], zd)
         returnValue("added")
 
     @inlineCallbacks
-    def remote_add_host(self, hostname):
+    def remote_add_host(self, hostname, other_names=()):
+        # One client can be granted several names (and *.ZONE wildcards), so
+        # it can put them all on one certificate: one ACME order instead of
+        # one per name. They must all be in hostname's zone.
+        metrics.inc("flancer_foolscap_calls_total", method="add_host")
         zone = extract_zone(hostname)
-        d = self._data["zones"][zone]["hostname_swissnums"]
+        if zone not in self._data["zones"]:
+            raise ValueError("hostname %s not in a registered zone" % hostname)
+        names = [hostname] + [n for n in other_names if n != hostname]
+        for name in names:
+            if extract_zone(name) != zone:
+                raise ValueError("%s is not in zone %s" % (name, zone))
         swissnum = make_swissnum()
-        d.append( (hostname, swissnum) )
-        self._data.save()
+        entry = (hostname, swissnum)
+        if names != [hostname] or hostname.startswith("*."):
+            entry = (hostname, swissnum, names)
+        self._data.append(["zones", zone, "hostname_swissnums"], entry)
+        self._add_controller(swissnum, HostController(hostname, self._server,
+                                                      names))
         assert self._furl_prefix
         furl = self._furl_prefix + swissnum
         returnValue(furl)
@@ -190,16 +658,16 @@ class Controller(Referenceable, object):
 
     @inlineCallbacks
     def remote_add_dyndns(self, hostname):
+        metrics.inc("flancer_foolscap_calls_total", method="add_dyndns")
         zone = extract_zone(hostname)
         if zone not in self._data["zones"]:
             returnValue( (False, "hostname %s not in a registered zone" % hostname) )
         swissnum = make_swissnum()
-        if "dyndns" not in self._data:
-            self._data["dyndns"] = {}
-        if hostname in self._data["dyndns"]:
-            self._server.clearRecord(hostname)
-        self._data["dyndns"][hostname] = swissnum
-        self._data.save()
+        if hostname in self._data.get("dyndns", {}):
+            self._server.clear_dyndns(hostname)
+            self._controllers.pop(self._data["dyndns"][hostname], None)
+        self._data.set(["dyndns", hostname], swissnum, create=True)
+        self._add_controller(swissnum, DyndnsController(hostname, self._server))
         assert self._furl_prefix
         furl = self._furl_prefix + swissnum
         returnValue( (True, furl) )
@@ -209,51 +677,181 @@ class Controller(Referenceable, object):
 class Server(object):
     _data = attr.ib()
     _dns_server = attr.ib()
+    # a ReadinessChecker, or None to take every record as served at once
+    readiness = attr.ib(default=None)
+    # a TXTRecordLimits, or None to keep TXT records until deleted
+    txt_limits = attr.ib(default=None)
+    # a ChallengeWatch, or None if clients cannot subscribe to queries
+    challenges = attr.ib(default=None)
+    # the DNSWorkerPool answering our DNS port, if --dns-workers
+    workers = None
 
     def __attrs_post_init__(self):
         self._records = {}
         self._authorities = {}
+        self._resolver = ZoneResolver()
+        self._dns_server.resolver = self._resolver
+        self._canaries = {} # dyndns hostname -> connected canaries
+        # observers are told zone_added(zone, authority), zone_removed(zone)
+        # and (via each authority) records_changed(zone, authority, names)
+        self._observers = []
+        if self.txt_limits is not None:
+            self.add_observer(self.txt_limits)
+        if self.challenges is not None:
+            self.add_observer(self.challenges)
+            self._dns_server.query_observer = self.challenges.queried
+        metrics.gauge("flancer_txt_records", self._count_txt_records)
+        metrics.gauge("flancer_dyndns_canaries",
+                      lambda: sum(self._canaries.values()))
+
+    def _count_txt_records(self):
+        return [({"zone": z}, da.records.count(dns.TXT))
+                for (z, da) in self._authorities.items()]
+
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
+    def authorities(self):
+        return dict(self._authorities)
+
+    def canary_connected(self, hostname):
+        self._canaries[hostname] = self._canaries.get(hostname, 0) + 1
+
+    def canary_lost(self, hostname):
+        self._canaries[hostname] -= 1
+        if not self._canaries[hostname]:
+            del self._canaries[hostname]
+
+    def add_zone(self, z):
+        # only the new zone is built: the other authorities, and the TXT and
+        # dyndns records they are serving, are left alone
+        if z in self._authorities:
+            return
+        zd = self._data["zones"][z]
+        soa = dns.Record_SOA(
+            mname=zd["server_name"],
+            rname="root." + z, # what is this for?
+            # must be int, fit in struct.pack("L") so 32-bits. Each change
+            # adds one. Starting from the clock (or past the saved serial,
+            # see RecordStore) means a restart does not send the serial
+            # backwards, so secondaries keep following it.
+            serial=int(time.time()) % 2**32,
+            refresh="1M",
+            retry="1M",
+            expire="1M",
+            minimum="1M",
+            )
+        ns = dns.Record_NS(zd["server_name"])
+        records = {
+            z: [soa, ns],
+            }
+        da = DynamicAuthority(z, soa, records)
+        da.observers = self._observers
+        self._authorities[z] = da
+        self._resolver.addZone(z, da)
+        for o in self._observers:
+            o.zone_added(z, da)
+
+    def remove_zone(self, z):
+        if self._authorities.pop(z, None) is not None:
+            self._resolver.removeZone(z)
+            for o in self._observers:
+                o.zone_removed(z)
 
     def update_records(self):
-        resolvers = []
-        self._da = {}
-        for z,zd in self._data["zones"].items():
-            soa = dns.Record_SOA(
-                mname=zd["server_name"],
-                rname="root." + z, # what is this for?
-                serial=1, # must be int, fit in struct.pack("L") so 32-bits
-                refresh="1M",
-                retry="1M",
-                expire="1M",
-                minimum="1M",
-                )
-            ns = dns.Record_NS(zd["server_name"])
-            records = {
-                z: [soa, ns],
-                }
-            da = DynamicAuthority(z, soa, records)
-            resolvers.append(da)
-            self._authorities[z] = da
-        print(self._dns_server.resolver)
-        self._dns_server.resolver = ResolverChain(resolvers)
+        # bring the authorities in line with self._data["zones"]
+        for z in self._data["zones"]:
+            self.add_zone(z)
+        for z in list(self._authorities):
+            if z not in self._data["zones"]:
+                self.remove_zone(z)
+
+    def _zone_of(self, hostname):
+        # hostname is like 'test1.sf.example.com', but 'sf.example.com' is
+        # what's in self._authorities. A wildcard certificate's challenge
+        # goes on the zone itself.
+        if hostname in self._authorities:
+            return hostname
+        return hostname.split(".", 1)[-1]
 
     def add_txt(self, hostname, txtname, data):
-        # hostname is like 'test1.sf.example.com'
-        # but 'sf.example.com' is what's in self._authorities
-        zone = hostname.split(".", 1)[1]
+        metrics.inc("flancer_record_changes_total", op="add_txt")
+        zone = self._zone_of(hostname)
         if zone not in self._authorities:
             raise KeyError("zone '%s' not in authorities %s" %
                            (zone, self._authorities.keys()))
+        if self.txt_limits is not None:
+            error = self.txt_limits.check(zone, "%s.%s" % (txtname, hostname),
+                                          {})
+            if error:
+                raise ValueError(error)
         self._authorities[zone].setTXT(hostname, txtname, data)
 
     def delete_txt(self, hostname, txtname):
-        zone = hostname.split(".", 1)[1]
+        metrics.inc("flancer_record_changes_total", op="delete_txt")
+        zone = self._zone_of(hostname)
         if zone not in self._authorities:
             raise KeyError("zone '%s' not in authorities %s" %
                            (zone, self._authorities.keys()))
         self._authorities[zone].deleteTXT(hostname, txtname)
 
+    def update_txts(self, changes):
+        """
+        Add or delete many TXT records, each change being (hostname, txtname,
+        data) with data=None for a delete. Each zone's authority is updated
+        once. Returns an (ok, error) tuple for each change, in order.
+        """
+        metrics.inc("flancer_record_changes_total", len(changes),
+                    op="update_txts")
+        results = [None] * len(changes)
+        by_zone = {}
+        pending = {} # for txt_limits.check
+        for i, (hostname, txtname, data) in enumerate(changes):
+            zone = self._zone_of(hostname)
+            if zone not in self._authorities:
+                results[i] = (False, "zone '%s' not in authorities" % zone)
+                continue
+            if data is not None and self.txt_limits is not None:
+                error = self.txt_limits.check(
+                    zone, "%s.%s" % (txtname, hostname), pending)
+                if error:
+                    results[i] = (False, error)
+                    continue
+            by_zone.setdefault(zone, []).append(i)
+        for zone, indices in by_zone.items():
+            applied = self._authorities[zone].updateTXTs(
+                [changes[i] for i in indices])
+            for i, r in zip(indices, applied):
+                results[i] = r
+        return results
+
+    def confirm_txts(self, changes):
+        """
+        Wait until each (hostname, txtname, data) TXT record is being served
+        by our DNS listener and the secondaries. Returns a Deferred that
+        fires with an (ok, error) tuple for each record, in order.
+        """
+        d = gatherResults([self._confirm_txt(*change) for change in changes])
+        d.addCallback(lambda problems: [(not p, p) for p in problems])
+        return d
+
+    def _confirm_txt(self, hostname, txtname, data):
+        checks = []
+        if self.readiness is not None:
+            checks.append(self.readiness.check("%s.%s" % (txtname, hostname),
+                                               data))
+        zone = self._zone_of(hostname)
+        if self.workers is not None and zone in self._authorities:
+            # the record is in the current serial, if it is there at all
+            checks.append(self.workers.served(
+                zone, self._authorities[zone].soa[1].serial))
+        d = gatherResults(checks)
+        d.addCallback(lambda problems: "; ".join(p for p in problems if p)
+                      or None)
+        return d
+
     def set_dyndns(self, hostname, record):
+        metrics.inc("flancer_record_changes_total", op="set_dyndns")
         zone = hostname.split(".", 1)[1]
         assert zone in self._authorities
         self._authorities[zone].setRecord(hostname, record)
@@ -261,36 +859,26 @@ class Server(object):
     def clear_dyndns(self, hostname):
         zone = hostname.split(".", 1)[1]
         assert zone in self._authorities
-        self._authorities[zone].clearRecord(hostname)
+        if hostname in self._authorities[zone].records:
+            self._authorities[zone].clearRecord(hostname)
 
     @inlineCallbacks
     def test_zone(self, zone_name):
         print("testing new zone %s" % zone_name)
         hostname = "_flancer_test.%s" % zone_name
         txtname = "_flancer_txtname"
-        fullname = "%s.%s" % (txtname, hostname)
-        test_data = "flancer_txt"
+        test_data = b"flancer_txt"
         self.add_txt(hostname, txtname, test_data)
         try:
-            res = yield dns_client.lookupText(fullname)
-        except DNSNameError as e:
-            print("failure to test zone: is there an NS record pointing to us?")
-            print(e)
+            [(ok, error)] = yield self.confirm_txts([(hostname, txtname,
+                                                      test_data)])
+        finally:
             self.delete_txt(hostname, txtname)
-            raise ValueError("failure to test zone: DNS error. Is there an NS record pointing to us?")
-        #print("result", res)
-        (answer, authority, additional) = res
-        for r in answer:
-            #print("R", r, dir(r))
-            if r.type == dns.TXT:
-                #print("TXT", r.payload.data[0])
-                if r.payload.data[0] == test_data:
-                    print("success")
-                    self.delete_txt(hostname, txtname)
-                    returnValue(True)
-        print("failure to test zone: is there an NS record pointing to us?")
-        self.delete_txt(hostname, txtname)
-        raise ValueError("failure to test zone: is there an NS record pointing to us?")
+        if not ok:
+            print("failure to test zone: %s" % error)
+            raise ValueError("failure to test zone: %s" % error)
+        print("success")
+        returnValue(True)
 
 def makeService(config, reactor=reactor):
     parent = MultiService()
@@ -299,18 +887,59 @@ def makeService(config, reactor=reactor):
     basedir.chmod(0o700)
 
     data = Data(basedir.child("config.json"))
-
-    dns_server = DNSServerFactory(verbose=0)
-    s1 = UDPServer(int(config["dns-port"]), dns.DNSDatagramProtocol(dns_server),
-                   interface=config["dns-interface"])
-    s1.setServiceParent(parent)
-    s2 = TCPServer(int(config["dns-port"]), dns_server,
-                   interface=config["dns-interface"])
-    s2.setServiceParent(parent)
-
-    s = Server(data, dns_server)
+    log.level = parse_level(config["log-level"])
+
+    dns_server = FlancerDNSServerFactory(verbose=0)
+    workers = int(config["dns-workers"])
+    # readiness is checked against what the world will query: our DNS port
+    # and the secondaries. Queries to our port could reach any of the
+    # --dns-workers, so those are asked instead (see DNSWorkerPool.served).
+    local = [local_address(config["dns-interface"], int(config["dns-port"]))]
+    readiness = ReadinessChecker(
+        reactor, ([] if workers else local) + config.secondaries,
+        timeout=float(config["ready-timeout"]))
+    txt_limits = TXTRecordLimits(reactor, float(config["txt-lifetime"]),
+                                 int(config["max-txt-per-host"]),
+                                 int(config["max-txt-per-zone"]))
+    s = Server(data, dns_server, readiness, txt_limits,
+               ChallengeWatch(reactor))
     s.update_records()
 
+    rate_limit = None
+    if float(config["rate-limit"]):
+        rate_limit = {"rate": float(config["rate-limit"]),
+                      "slip": int(config["rate-limit-slip"])}
+    allow_transfer = list(config.allow_transfer)
+    allow_transfer.extend(host for (host, port) in config.secondaries)
+    # these also go to each --dns-workers process
+    dns_options = {"rate_limit": rate_limit, "allow_transfer": allow_transfer}
+    dns_server.configure(reactor, **dns_options)
+
+    # restores the records clients set before we restarted: it must start
+    # before the DNS ports open
+    store = RecordStore(reactor, basedir.child("records.json"), s,
+                        txt_lifetime=float(config["txt-lifetime"]))
+    store.setServiceParent(parent)
+
+    if workers:
+        # the workers answer DNS, this process only publishes records
+        pool = DNSWorkerPool(reactor, s, workers, int(config["dns-port"]),
+                             config["dns-interface"], options=dns_options,
+                             ready_timeout=float(config["ready-timeout"]))
+        pool.setServiceParent(parent)
+        s.workers = pool
+    else:
+        s1 = UDPServer(int(config["dns-port"]),
+                       dns.DNSDatagramProtocol(dns_server),
+                       interface=config["dns-interface"])
+        s1.setServiceParent(parent)
+        s2 = TCPServer(int(config["dns-port"]), dns_server,
+                       interface=config["dns-interface"])
+        s2.setServiceParent(parent)
+
+    if config.secondaries:
+        Notifier(reactor, s, config.secondaries).setServiceParent(parent)
+
     certFile = basedir.child("tub.data").path
     #furlFile = basedir.child("server.furl").path
     t = Tub(certFile=certFile)
@@ -334,4 +963,9 @@ def makeService(config, reactor=reactor):
     t.registerNameLookupHandler(c.lookup)
 
     t.setServiceParent(parent)
+
+    if config["metrics-port"] or float(config["metrics-log-interval"]):
+        ms = makeMetricsService(config["metrics-port"],
+                                float(config["metrics-log-interval"]))
+        ms.setServiceParent(parent)
     return parent
@@ -0,0 +1,103 @@
+import attr
+from foolscap.api import DeadReferenceError
+from ..eventlog import EventLog
+from ..metrics import metrics
+
+log = EventLog("flancer.server.watch")
+
+# The client cannot see when the ACME server's resolvers look up its
+# _acme-challenge record, so it would only learn that validation happened
+# the next time it polls the authorization. A client can subscribe (through
+# its HostController) to be told, over foolscap, each time a new resolver
+# queries one of its host's challenge records: the first such message means
+# validation is under way. Queries are only looked at when someone has
+# subscribed for that host, so this costs a dict lookup per TXT query.
+
+CHALLENGE_PREFIX = "_acme-challenge."
+MAX_RESOLVERS = 16 # per challenge value, beyond that we stop telling
+
+@attr.s(cmp=False)
+class ChallengeWatch(object):
+    _reactor = attr.ib()
+
+    def __attrs_post_init__(self):
+        self._subscribers = {} # granted name -> set of RemoteReferences
+        self._set_at = {} # challenge name -> when its value was set
+        self._seen = {} # challenge name -> set of resolvers that asked
+
+    def subscribe(self, names, observer):
+        # 'names' are what the client was granted: hostnames or *.ZONE
+        for name in names:
+            self._subscribers.setdefault(name, set()).add(observer)
+            observer.notifyOnDisconnect(self._unsubscribe, name, observer)
+
+    def _unsubscribe(self, name, observer):
+        observers = self._subscribers.get(name, set())
+        observers.discard(observer)
+        if not observers:
+            self._subscribers.pop(name, None)
+
+    def _observers(self, hostname):
+        # the grants which cover hostname, see tap.covers()
+        observers = set()
+        for grant in (hostname, "*." + hostname,
+                      "*." + hostname.split(".", 1)[-1]):
+            observers.update(self._subscribers.get(grant, ()))
+        return observers
+
+    def queried(self, name, resolver):
+        """
+        Called by the DNS frontend (ours, or a worker's) for every TXT query.
+        """
+        if not name.startswith(CHALLENGE_PREFIX):
+            return
+        if name not in self._set_at:
+            # no such record (yet): anyone can ask for random names, which
+            # must not grow _seen or reach the clients
+            return
+        hostname = name[len(CHALLENGE_PREFIX):]
+        observers = self._observers(hostname)
+        if not observers:
+            return
+        seen = self._seen.setdefault(name, set())
+        if resolver in seen or len(seen) >= MAX_RESOLVERS:
+            return
+        seen.add(resolver)
+        age = self._reactor.seconds() - self._set_at[name]
+        metrics.inc("flancer_challenge_queries_total",
+                    first="yes" if len(seen) == 1 else "no")
+        log.info("{name} queried by {resolver}, {age:.1f}s after it was set",
+                 name=name, resolver=resolver, age=age)
+        for observer in observers:
+            d = observer.callRemote("challenge_queried", name, resolver, age)
+            d.addErrback(self._failed, hostname, observer)
+
+    def _failed(self, f, hostname, observer):
+        if f.check(DeadReferenceError):
+            for name in list(self._subscribers):
+                self._unsubscribe(name, observer)
+        else:
+            log.warn("challenge_queried to {hostname} failed: {failure}",
+                     hostname=hostname, failure=f)
+
+    # observer interface, see Server.add_observer
+
+    def zone_added(self, zone, da):
+        self.records_changed(zone, da, list(da.records))
+
+    def zone_removed(self, zone):
+        suffix = "." + zone
+        for name in [n for n in self._set_at if n.endswith(suffix)]:
+            self._set_at.pop(name)
+            self._seen.pop(name, None)
+
+    def records_changed(self, zone, da, names):
+        # a new challenge value starts a new validation
+        now = self._reactor.seconds()
+        for name in names:
+            if name.startswith(CHALLENGE_PREFIX):
+                self._seen.pop(name, None)
+                if name in da.records:
+                    self._set_at[name] = now
+                else:
+                    self._set_at.pop(name, None)
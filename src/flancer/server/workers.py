@@ -0,0 +1,348 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import base64
+import socket
+from io import BytesIO
+import attr
+from twisted.application.service import Service
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.names import dns
+from ..eventlog import EventLog
+from .watch import CHALLENGE_PREFIX
+
+log = EventLog("flancer.server.workers")
+
+# With --dns-workers=N, DNS is answered by N child processes which all bind
+# --dns-port with SO_REUSEPORT, so the kernel spreads queries across them
+# (and across cores), while the main process keeps the Tub and Controller.
+# The main process owns the records: it writes one JSON line per zone or
+# name change to each worker's stdin, and a full snapshot when a worker
+# (re)starts. A snapshot is split into messages of SNAPSHOT_CHUNK names, so
+# no line grows with the zone, and ends with "snapshot_done": only then
+# does the worker bind the port, so it never answers REFUSED for zones it
+# has not loaded yet. Record data travels in DNS wire format, so any record
+# type the authority can hold is carried unchanged. Workers report back the
+# same way, on their stdout: the serial of each change once they are
+# serving it (so Server.confirm_txts can wait for every worker), and
+# queries for challenge records.
+
+def encode_record(record):
+    buf = BytesIO()
+    record.encode(buf, None)
+    return {"type": record.TYPE, "ttl": record.ttl,
+            "rdata": base64.b64encode(buf.getvalue()).decode("ascii")}
+
+def decode_record(d):
+    rdata = base64.b64decode(d["rdata"])
+    record = dns.Message().lookupRecordType(d["type"])()
+    record.decode(BytesIO(rdata), len(rdata))
+    record.ttl = d["ttl"]
+    return record
+
+def _encode_records(da, names):
+    return dict((name, [encode_record(r) for r in da.records.get(name, [])])
+                for name in names)
+
+SNAPSHOT_CHUNK = 1000 # names per message
+
+def _zone_messages(zone, da):
+    # a "zone" message, then "zone_records" ones: the last says "done"
+    names = list(da.records)
+    chunks = [names[i:i+SNAPSHOT_CHUNK]
+              for i in range(0, len(names), SNAPSHOT_CHUNK)] or [[]]
+    for i, chunk in enumerate(chunks):
+        message = {"op": "zone_records", "zone": zone,
+                   "records": _encode_records(da, chunk),
+                   "done": i == len(chunks) - 1}
+        if i == 0:
+            message["op"] = "zone"
+            message["soa"] = encode_record(da.soa[1])
+        yield message
+
+def _serial_reached(have, want):
+    # RFC 1982 serial number arithmetic: is 'have' at or after 'want'?
+    return (have - want) % 2**32 < 2**31
+
+def _records_message(zone, da, names):
+    # one message per change, carrying its serial, so the worker's IXFR
+    # journal has the same entries as ours
+    return {"op": "records", "zone": zone, "serial": da.soa[1].serial,
+            "records": _encode_records(da, names)}
+
+class _WorkerProtocol(ProcessProtocol):
+    def __init__(self, pool, index):
+        self._pool = pool
+        self.index = index
+        self._buffer = b""
+
+    def connectionMade(self):
+        self._pool._worker_started(self)
+
+    def send(self, message):
+        self.transport.write((json.dumps(message) + "\n").encode("utf-8"))
+
+    def outReceived(self, data):
+        # the worker reports events to us as JSON lines on its stdout
+        lines = (self._buffer + data).split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            try:
+                message = json.loads(line.decode("utf-8"))
+            except ValueError:
+                self.errReceived(line + b"\n")
+                continue
+            self._pool._worker_message(message)
+
+    def errReceived(self, data):
+        for line in data.decode("utf-8", "replace").splitlines():
+            log.info("dns worker {index}: {line}", index=self.index, line=line)
+
+    def processEnded(self, reason):
+        self._pool._worker_ended(self, reason)
+
+@attr.s(cmp=False)
+class DNSWorkerPool(Service, object):
+    _reactor = attr.ib()
+    _server = attr.ib()
+    count = attr.ib()
+    port = attr.ib()
+    interface = attr.ib(default="")
+    restart_delay = attr.ib(default=5.0)
+    options = attr.ib(default=None) # FlancerDNSServerFactory.configure kwargs
+    ready_timeout = attr.ib(default=5.0) # see served()
+
+    def __attrs_post_init__(self):
+        self._workers = {} # index -> _WorkerProtocol, once running
+        self._applied = {} # index -> {zone: serial the worker is serving}
+        self._waiters = [] # (zone, serial, Deferred, timeout DelayedCall)
+
+    def startService(self):
+        Service.startService(self)
+        self._server.add_observer(self)
+        for index in range(self.count):
+            self._spawn(index)
+
+    def stopService(self):
+        Service.stopService(self)
+        for p in list(self._workers.values()):
+            p.transport.signalProcess("TERM")
+
+    def _spawn(self, index):
+        if not self.running:
+            return
+        # options carries the rate limit and transfer ACL, which each worker
+        # applies to the queries the kernel hands it
+        args = [sys.executable, "-m", "flancer.server.workers",
+                str(self.port), self.interface,
+                json.dumps(self.options or {}), str(index)]
+        self._reactor.spawnProcess(_WorkerProtocol(self, index), sys.executable,
+                                   args, env=os.environ,
+                                   childFDs={0: "w", 1: "r", 2: "r"})
+
+    def _worker_started(self, p):
+        self._workers[p.index] = p
+        self._applied[p.index] = {}
+        for zone, da in self._server.authorities().items():
+            for message in _zone_messages(zone, da):
+                p.send(message)
+        p.send({"op": "snapshot_done"})
+
+    def _worker_ended(self, p, reason):
+        self._workers.pop(p.index, None)
+        self._applied.pop(p.index, None)
+        self._check_waiters()
+        if self.running:
+            log.warn("dns worker {index} exited ({reason}), restarting",
+                     index=p.index, reason=reason.value)
+            self._reactor.callLater(self.restart_delay, self._spawn, p.index)
+
+    def _worker_message(self, message):
+        if message["op"] == "applied":
+            applied = self._applied.get(message["worker"])
+            if applied is not None:
+                applied[message["zone"]] = message["serial"]
+                self._check_waiters()
+        elif message["op"] == "queried":
+            if self._server.challenges is not None:
+                self._server.challenges.queried(message["name"],
+                                                message["resolver"])
+
+    def _lagging(self, zone, serial):
+        if not self._workers:
+            return ["(none running)"]
+        return [index for index in sorted(self._workers)
+                if not (zone in self._applied[index]
+                        and _serial_reached(self._applied[index][zone],
+                                            serial))]
+
+    def served(self, zone, serial):
+        """
+        Return a Deferred that fires with None once every worker is serving
+        'zone' at 'serial' or later, or with a description of the ones that
+        are not after ready_timeout. Our DNS port is whichever worker the
+        kernel picks, so all of them must have it.
+        """
+        if not self._lagging(zone, serial):
+            return succeed(None)
+        d = Deferred()
+        waiter = (zone, serial, d)
+        timer = self._reactor.callLater(self.ready_timeout, self._timed_out,
+                                        waiter)
+        self._waiters.append(waiter + (timer,))
+        return d
+
+    def _check_waiters(self):
+        for waiter in list(self._waiters):
+            (zone, serial, d, timer) = waiter
+            if not self._lagging(zone, serial):
+                self._waiters.remove(waiter)
+                timer.cancel()
+                d.callback(None)
+
+    def _timed_out(self, waiter):
+        for w in list(self._waiters):
+            if w[:3] == waiter:
+                self._waiters.remove(w)
+                lagging = self._lagging(waiter[0], waiter[1])
+                waiter[2].callback("dns workers %s not yet serving serial %d"
+                                   " of %s" % (", ".join(map(str, lagging)),
+                                               waiter[1], waiter[0]))
+
+    def _broadcast(self, message):
+        for p in self._workers.values():
+            p.send(message)
+
+    # observer interface, see Server.add_observer
+
+    def zone_added(self, zone, da):
+        for message in _zone_messages(zone, da):
+            self._broadcast(message)
+
+    def zone_removed(self, zone):
+        self._broadcast({"op": "remove_zone", "zone": zone})
+
+    def records_changed(self, zone, da, names):
+        self._broadcast(_records_message(zone, da, names))
+
+# the worker side
+
+def _reuseport_socket(kind, interface, port):
+    family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+    s = socket.socket(family, kind)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if kind == socket.SOCK_STREAM:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((interface, port))
+    if kind == socket.SOCK_STREAM:
+        s.listen(50)
+    s.setblocking(False)
+    return s, family
+
+class _UpdateReceiver(LineOnlyReceiver):
+    delimiter = b"\n"
+    MAX_LENGTH = 16*1024*1024
+
+    def __init__(self, resolver, reactor, index=0, listen=None):
+        self._resolver = resolver
+        self._reactor = reactor
+        self._index = index
+        self._listen = listen # called once the first snapshot is loaded
+        self._authorities = {}
+        self._loading = {} # zone -> (soa, records) until its snapshot is done
+
+    def lineReceived(self, line):
+        message = json.loads(line.decode("utf-8"))
+        op, zone = message["op"], message.get("zone")
+        if op == "snapshot_done" and self._listen is not None:
+            listen, self._listen = self._listen, None
+            listen()
+            # only now is the kernel handing us queries
+            for zone in self._authorities:
+                self._applied(zone)
+        if op == "zone":
+            self._loading[zone] = (decode_record(message["soa"]), {})
+        if op in ("zone", "zone_records"):
+            (soa, records) = self._loading[zone]
+            records.update(self._decode_records(message["records"]))
+            if message["done"]:
+                del self._loading[zone]
+                self._add_zone(zone, soa, records)
+                self._applied(zone)
+        elif op == "remove_zone":
+            self._authorities.pop(zone, None)
+            self._resolver.removeZone(zone)
+        elif op == "records":
+            self._authorities[zone].setRecords(
+                self._decode_records(message["records"]), message["serial"])
+            self._applied(zone)
+
+    def _send(self, message):
+        self.transport.write((json.dumps(message) + "\n").encode("utf-8"))
+
+    def _applied(self, zone):
+        if self._listen is not None:
+            return # reported once we are listening
+        self._send({"op": "applied", "worker": self._index, "zone": zone,
+                    "serial": self._authorities[zone].soa[1].serial})
+
+    def _add_zone(self, zone, soa, records):
+        from .tap import DynamicAuthority
+        # the apex SOA must be the same object, so serials track
+        records[zone] = [soa] + [r for r in records.get(zone, [])
+                                 if r.TYPE != dns.SOA]
+        da = self._authorities[zone] = DynamicAuthority(zone, soa, records)
+        self._resolver.addZone(zone, da)
+
+    def _decode_records(self, encoded):
+        return dict((name, [decode_record(r) for r in records])
+                    for (name, records) in encoded.items())
+
+    def queried(self, name, resolver):
+        # the main process has the subscribers, see ChallengeWatch. Only
+        # records we hold are worth telling it about.
+        if not name.startswith(CHALLENGE_PREFIX):
+            return
+        da = self._resolver.authorityFor(name)
+        if da is not None and name in da.records:
+            self._send({"op": "queried", "name": name, "resolver": resolver})
+
+    def connectionLost(self, reason):
+        # the main process has gone away
+        if self._reactor.running:
+            self._reactor.stop()
+
+def worker_main(port, interface, options, index=0):
+    from twisted.internet import reactor, stdio
+    from twisted.logger import globalLogBeginner, textFileLogObserver
+    from .tap import ZoneResolver, FlancerDNSServerFactory, log as server_log
+    from ..eventlog import parse_level
+
+    globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stderr)])
+    server_log.level = parse_level("warn")
+    resolver = ZoneResolver()
+    factory = FlancerDNSServerFactory(verbose=0)
+    factory.resolver = resolver
+    factory.configure(reactor, **options)
+
+    def listen():
+        udp, family = _reuseport_socket(socket.SOCK_DGRAM, interface, port)
+        reactor.adoptDatagramPort(udp.fileno(), family,
+                                  dns.DNSDatagramProtocol(factory))
+        udp.close()
+        tcp, family = _reuseport_socket(socket.SOCK_STREAM, interface, port)
+        reactor.adoptStreamPort(tcp.fileno(), family, factory)
+        tcp.close()
+
+    receiver = _UpdateReceiver(resolver, reactor, index, listen)
+    factory.query_observer = receiver.queried
+    stdio.StandardIO(receiver)
+    reactor.run()
+
+if __name__ == "__main__":
+    worker_main(int(sys.argv[1]), sys.argv[2] if len(sys.argv) > 2 else "",
+                json.loads(sys.argv[3]) if len(sys.argv) > 3 else {},
+                int(sys.argv[4]) if len(sys.argv) > 4 else 0)